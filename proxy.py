@@ -1,15 +1,52 @@
 import asyncio
+import collections
 import functools
+import http
+import itertools
 import json
 import os
+import random
+import signal
+import socket
+import subprocess
+import sys
 import time
+import tracemalloc
 import urllib.parse
 import werkzeug
+import zlib
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    # Needed for upstream h2c only.
+    h2 = None
 
 
 # Names of environment variables for configuration.
 PROXY_HOST_ENV = "PROXY_HOST"
 PROXY_PORT_ENV = "PROXY_PORT"
+PROXY_SEGMENT_CONCURRENCY_ENV = "PROXY_SEGMENT_CONCURRENCY"
+PROXY_SEGMENT_SIZE_ENV = "PROXY_SEGMENT_SIZE"
+PROXY_COMPRESSION_ENV = "PROXY_COMPRESSION"
+PROXY_PREFETCH_SEGMENTS_ENV = "PROXY_PREFETCH_SEGMENTS"
+PROXY_CAPTURE_FILE_ENV = "PROXY_CAPTURE_FILE"
+PROXY_CAPTURE_SAMPLE_RATE_ENV = "PROXY_CAPTURE_SAMPLE_RATE"
+PROXY_DRAIN_TIMEOUT_ENV = "PROXY_DRAIN_TIMEOUT"
+PROXY_H2C_BACKENDS_ENV = "PROXY_H2C_BACKENDS"
+
+# Name of environment variable with listening socket's file descriptor, handed
+# over to the new process on restart.
+PROXY_LISTEN_FD_ENV = "PROXY_LISTEN_FD"
+
+# Name of environment variable with file descriptor of pipe, through which the
+# new process reports it serves the handed over socket.
+PROXY_READY_FD_ENV = "PROXY_READY_FD"
 
 # Size of read buffers [bytes].
 READ_BUFFER_SIZE = 1024
@@ -17,6 +54,101 @@ READ_BUFFER_SIZE = 1024
 # Read timeout time [s].
 READ_TIMEOUT = 0.5
 
+# Overall time allowed for connecting to remote server [s].
+CONNECT_TIMEOUT = 10
+
+# Delay before racing a connection to the next resolved address (RFC 8305
+# "Connection Attempt Delay") [s].
+CONNECT_ATTEMPT_DELAY = 0.25
+
+# How long an address that failed to connect is skipped [s].
+FAILED_ADDRESS_TTL = 30
+
+# Number of concurrent upstream Range sub-requests of segmented fetching, which
+# is also the number of segments buffered for reordering. Segmented fetching
+# is off for values below 2.
+SEGMENT_CONCURRENCY = 0
+
+# Size of segments fetched with upstream Range sub-requests [bytes].
+SEGMENT_SIZE = 1024 * 1024
+
+# Time allowed for fetching single segment [s].
+SEGMENT_TIMEOUT = 30
+
+# Whether to gzip-compress responses for clients accepting that.
+COMPRESSION = False
+
+# Responses with shorter bodies aren't compressed [bytes].
+COMPRESSION_MIN_SIZE = 1024
+
+# Size of batches of body compressed at once in a worker thread [bytes].
+COMPRESSION_BATCH_SIZE = 64 * 1024
+
+# zlib compression level (1-9).
+COMPRESSION_LEVEL = 6
+
+# Content types (besides text/*) worth compressing.
+COMPRESSIBLE_TYPES = (
+    "application/javascript",
+    "application/json",
+    "application/xhtml+xml",
+    "application/xml",
+    "image/svg+xml",
+)
+
+# Number of segments read ahead for clients requesting ranges of an object
+# sequentially. Prefetching is off for 0.
+PREFETCH_SEGMENTS = 0
+
+# Number of sequential range requests before prefetching starts.
+PREFETCH_TRIGGER = 2
+
+# Maximum size of all prefetched segments held in memory [bytes].
+PREFETCH_STORE_SIZE = 64 * 1024 * 1024
+
+# Time prefetched segment is held for [s].
+PREFETCH_TTL = 30
+
+# Maximum number of tracked (client, object) range walks.
+PREFETCH_WALKS = 1024
+
+# Requests with any of these headers are neither prefetched for, nor served
+# prefetched segments - responses to them may be private to the client.
+PREFETCH_PRIVATE_HEADERS = ("authorization", "proxy-authorization", "cookie")
+
+# Fraction of requests captured, when capturing traffic.
+CAPTURE_SAMPLE_RATE = 1.0
+
+# Headers, values of which are not captured.
+CAPTURE_REDACTED_HEADERS = ("authorization", "proxy-authorization", "cookie")
+
+# Maximum size of response head looked for in data written to client [bytes].
+MAX_HEAD_SIZE = 64 * 1024
+
+# Time active connections are given to finish on shutdown or restart [s].
+DRAIN_TIMEOUT = 30
+
+# Interval of checking whether active connections finished [s].
+DRAIN_POLL_INTERVAL = 0.1
+
+# Time new process is given to start serving on restart [s].
+SUCCESSOR_TIMEOUT = 10
+
+# Maximum number of h2c connections to each h2c remote server.
+H2C_CONNECTIONS = 2
+
+# Flow control window of each h2c stream - maximum amount of response body
+# buffered per request [bytes].
+H2C_STREAM_WINDOW = 256 * 1024
+
+# Flow control window of each h2c connection, shared by its streams [bytes].
+H2C_CONNECTION_WINDOW = 16 * 1024 * 1024
+
+# Request headers not relayed over h2c (connection-specific or replaced by
+# pseudo-headers).
+H2C_STRIPPED_HEADERS = ("host", "connection", "keep-alive", "proxy-connection",
+                        "transfer-encoding", "upgrade", "te", "http2-settings")
+
 
 async def _relay_ranged_body_to_client(remote, client, stats, bytes_ranges):
     """Relay response body with handling ranges of bytes.
@@ -175,7 +307,153 @@ async def _relay_body_to_client(remote, client, stats):
         await client.drain()
 
 
-async def relay_to_client(remote, client, stats, bytes_ranges=None):
+def _compress_final(compressor, data):
+    """Compress last batch of data and flush the compressor."""
+
+    return compressor.compress(data) + compressor.flush()
+
+
+async def _relay_compressed_body_to_client(remote, client, stats, status_line,
+                                           header_lines):
+    """Relay response gzip-compressed, if its body is worth compressing.
+
+    Bodies already encoded (or chunked), of content types not listed as
+    compressible and shorter than ``COMPRESSION_MIN_SIZE`` are relayed as they
+    are. Otherwise the body is compressed in ``COMPRESSION_BATCH_SIZE`` batches
+    in worker threads and relayed with chunked framing.
+
+    :param asyncio.StreamReader remote: remote server's reader stream
+    :param asyncio.StreamWriter client: proxy's client writer stream
+    :param Stats stats: stats object
+    :param bytes status_line: already read status line of the response
+    :param list header_lines: already read header lines of the response
+
+    """
+
+    headers = {}
+    for line in header_lines:
+        key, value = line.decode().split(":", maxsplit=1)
+        headers[key.lower().strip()] = value.strip()
+
+    content_type = headers.get("content-type", "").split(";")[0].strip()
+    compress = "content-encoding" not in headers \
+        and "transfer-encoding" not in headers \
+        and (content_type.lower().startswith("text/")
+             or content_type.lower() in COMPRESSIBLE_TYPES)
+    if compress and "content-length" in headers:
+        compress = headers["content-length"].isdigit() \
+            and int(headers["content-length"]) >= COMPRESSION_MIN_SIZE
+
+    # Read ahead to tell tiny bodies of unknown length.
+    body = bytearray()
+    eof = False
+    if compress:
+        while len(body) < COMPRESSION_MIN_SIZE:
+            try:
+                buf = await asyncio.wait_for(remote.read(READ_BUFFER_SIZE),
+                                             READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                buf = b""
+
+            if len(buf) == 0:
+                eof = True
+                break
+
+            body += buf
+
+        compress = len(body) >= COMPRESSION_MIN_SIZE
+
+    if not compress:
+        # Relay response as it is.
+        for line in [status_line] + header_lines + [b"\r\n", body]:
+            stats.total_bytes_transferred += len(line)
+            client.write(line)
+        await client.drain()
+
+        if not eof:
+            await _relay_body_to_client(remote, client, stats)
+        return
+
+    # Relay status and headers rewritten for compressed, chunked body. Proxy
+    # frames the body itself, thus speaks HTTP/1.1. Remote server's
+    # connection options (hop-by-hop headers) don't apply to the client's
+    # connection, which gets closed.
+    hop_by_hop = {"content-length", "connection", "keep-alive"}
+    hop_by_hop.update(option.strip().lower()
+                      for option in headers.get("connection", "").split(","))
+    head = b"HTTP/1.1 " + status_line.split(maxsplit=1)[1]
+    for line in header_lines:
+        key, value = line.split(b":", maxsplit=1)
+        key = key.lower().strip()
+        if key.decode() in hop_by_hop:
+            continue
+        elif key == b"etag" and not value.strip().startswith(b"W/"):
+            # Compressed representation is not byte-for-byte the same.
+            line = b"ETag: W/" + value.strip() + b"\r\n"
+        head += line
+    head += (b"Content-Encoding: gzip\r\n"
+             b"Transfer-Encoding: chunked\r\n"
+             b"Vary: Accept-Encoding\r\n"
+             b"Connection: close\r\n\r\n")
+
+    # Update stats.
+    stats.total_bytes_transferred += len(head)
+
+    # Send data to the client, wait for the writer to flush.
+    client.write(head)
+    await client.drain()
+
+    loop = asyncio.get_event_loop()
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    while True:
+        # Gather a batch of body.
+        while not eof and len(body) < COMPRESSION_BATCH_SIZE:
+            try:
+                buf = await asyncio.wait_for(remote.read(READ_BUFFER_SIZE),
+                                             READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                buf = b""
+
+            if len(buf) == 0:
+                eof = True
+                break
+
+            body += buf
+
+        # Compress the batch in a worker thread, not to block the loop.
+        if eof:
+            data = await loop.run_in_executor(None, _compress_final,
+                                              compressor, body)
+        else:
+            data = await loop.run_in_executor(None, compressor.compress,
+                                              body)
+
+        # Update stats.
+        stats.compression_bytes_saved += len(body) - len(data)
+        body = bytearray()
+
+        if data:
+            chunk = b"%x\r\n" % len(data) + data + b"\r\n"
+
+            # Update stats.
+            stats.total_bytes_transferred += len(chunk)
+
+            # Send data to the client, wait for the writer to flush.
+            client.write(chunk)
+            await client.drain()
+
+        if eof:
+            break
+
+    # Update stats, put last chunk.
+    stats.total_bytes_transferred += len(b"0\r\n\r\n")
+    client.write(b"0\r\n\r\n")
+    await client.drain()
+
+
+async def relay_to_client(remote, client, stats, bytes_ranges=None,
+                          compress=False):
     """Relay response from remote server to client.
 
     Relay response headers, checking whether remote server handled ranges for
@@ -186,6 +464,7 @@ async def relay_to_client(remote, client, stats, bytes_ranges=None):
     :param Stats stats: stats object
     :param werkzeug.datastructures.Ranges bytes_ranges: optional ranges
                                                         specification
+    :param bool compress: whether client accepts gzip-compressed response
 
     """
 
@@ -199,14 +478,21 @@ async def relay_to_client(remote, client, stats, bytes_ranges=None):
 
     # If client requested range(s), rewrite status code.
     if bytes_ranges:
-        line = "{} 206 Partial Content".format(http_version).encode()
+        line = "{} 206 Partial Content\r\n".format(http_version).encode()
 
-    # Update stats.
-    stats.total_bytes_transferred += len(line)
+    # Only whole bodies of successful responses are compressed. Decision needs
+    # all headers, so these are relayed later.
+    compress = compress and not bytes_ranges and int(status_code) == 200
+    status_line = line
+    header_lines = []
 
-    # Send data to the client, wait for the writer to flush.
-    client.write(line)
-    await client.drain()
+    if not compress:
+        # Update stats.
+        stats.total_bytes_transferred += len(line)
+
+        # Send data to the client, wait for the writer to flush.
+        client.write(line)
+        await client.drain()
 
     # Relay headers.
     while True:
@@ -225,6 +511,10 @@ async def relay_to_client(remote, client, stats, bytes_ranges=None):
         key, value = data.split(":", maxsplit=1)
         key = key.lower().strip()
 
+        if compress:
+            header_lines.append(line)
+            continue
+
         # Update stats.
         stats.total_bytes_transferred += len(data)
 
@@ -232,6 +522,11 @@ async def relay_to_client(remote, client, stats, bytes_ranges=None):
         client.write(line)
         await client.drain()
 
+    if compress:
+        await _relay_compressed_body_to_client(remote, client, stats,
+                                               status_line, header_lines)
+        return
+
     # Update stats, ut CRLF after the headers.
     stats.total_bytes_transferred += len(b"\r\n")
     client.write(b"\r\n")
@@ -269,7 +564,561 @@ async def relay_to_remote(client, remote):
         await remote.drain()
 
 
-async def on_connected(client_reader, client_writer, listen_on, stats):
+def _interleave_addresses(addrinfos):
+    """Order resolved addresses for connection racing.
+
+    Alternates address families, starting with the first family returned by
+    the resolver (RFC 8305, section 4), and drops duplicates.
+
+    :param list addrinfos: result of ``getaddrinfo()``
+    :returns: list of ``(family, type, proto, sockaddr)`` tuples
+
+    """
+
+    families = collections.OrderedDict()
+    seen = set()
+    for family, type_, proto, _, sockaddr in addrinfos:
+        if sockaddr in seen:
+            continue
+        seen.add(sockaddr)
+        families.setdefault(family, []).append(
+            (family, type_, proto, sockaddr))
+
+    return [address
+            for group in itertools.zip_longest(*families.values())
+            for address in group
+            if address is not None]
+
+
+async def _connect_address(address):
+    """Open connection to single, already resolved address.
+
+    :param tuple address: ``(family, type, proto, sockaddr)`` tuple
+    :returns: ``(reader, writer)`` pair of streams
+
+    """
+
+    family, type_, proto, sockaddr = address
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        await asyncio.get_event_loop().sock_connect(sock, sockaddr)
+        return await asyncio.open_connection(sock=sock)
+    except BaseException:
+        # Also on cancellation - lost race shouldn't leak the socket.
+        sock.close()
+        raise
+
+
+async def _race_connections(addresses, failures, timeout=None):
+    """Race connections to addresses with staggered starts.
+
+    Next attempt starts after ``CONNECT_ATTEMPT_DELAY`` or as soon as
+    a previous one fails, whichever comes first. First established connection
+    wins, the others are cancelled (or closed, if established at the same
+    time).
+
+    :param list addresses: addresses as returned by ``_interleave_addresses``
+    :param AddressFailureCache failures: cache of failed addresses
+    :param float timeout: optional time limit of the whole race [s]
+    :returns: ``(reader, writer)`` pair of streams
+    :raises asyncio.TimeoutError: when no connection is established in time -
+                                  addresses still connecting are then
+                                  considered failed (e.g. blackholed)
+
+    """
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout if timeout is not None else None
+    addresses = list(addresses)
+    attempts = {}  # Task -> address it connects to.
+    error = None
+    winner = None
+    try:
+        while winner is None and (addresses or attempts):
+            # Start next attempt, if any address left.
+            if addresses:
+                address = addresses.pop(0)
+                task = asyncio.ensure_future(_connect_address(address))
+                attempts[task] = address
+
+            wait = CONNECT_ATTEMPT_DELAY if addresses else None
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    for address in attempts.values():
+                        failures.add(address[3])
+                    raise asyncio.TimeoutError()
+                wait = remaining if wait is None else min(wait, remaining)
+
+            done, _ = await asyncio.wait(
+                list(attempts),
+                timeout=wait,
+                return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                address = attempts.pop(task)
+                if task.exception() is not None:
+                    failures.add(address[3])
+                    error = task.exception()
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    # Tie - more than one connection established at once.
+                    task.result()[1].close()
+    finally:
+        for task in attempts:
+            task.cancel()
+
+    if winner is None:
+        raise error
+
+    return winner
+
+
+async def open_remote_connection(host, port, failures):
+    """Open connection to remote server.
+
+    Name is resolved to all its addresses, which are then raced against each
+    other (Happy Eyeballs, RFC 8305). Addresses which recently failed are
+    tried last.
+
+    :param str host: remote server's host name or address
+    :param int port: remote server's port
+    :param AddressFailureCache failures: cache of failed addresses
+    :returns: ``(reader, writer)`` pair of streams
+    :raises OSError: when name can't be resolved or no connection succeeds
+    :raises asyncio.TimeoutError: when connecting takes longer than
+                                  ``CONNECT_TIMEOUT``
+
+    """
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + CONNECT_TIMEOUT
+    addrinfos = await asyncio.wait_for(
+        loop.getaddrinfo(host, port, type=socket.SOCK_STREAM),
+        CONNECT_TIMEOUT)
+
+    # Stable sort - order of the rest is kept.
+    addresses = sorted(_interleave_addresses(addrinfos),
+                       key=lambda address: address[3] in failures)
+
+    return await _race_connections(addresses, failures,
+                                   max(deadline - loop.time(), 0))
+
+
+async def _read_response_head(remote):
+    """Read status line and headers of response.
+
+    :param asyncio.StreamReader remote: remote server's reader stream
+    :returns: ``(status_line, status_code, header_lines)`` where
+              ``status_line`` and ``header_lines`` are decoded (with CRLF)
+    :raises ConnectionError: when response has no proper status line (e.g.
+                             remote server closed the connection)
+
+    """
+
+    status_line = await remote.readline()
+    try:
+        http_version, status_code, *description = status_line.decode().split()
+        status_code = int(status_code)
+    except ValueError:
+        raise ConnectionError(
+            "No status line in response: {!r}".format(status_line))
+
+    header_lines = []
+    while True:
+        line = await remote.readline()
+
+        # When no proper line - either end of headers or premature end of the
+        # response.
+        if not line or line == b"\r\n":
+            break
+
+        header_lines.append(line.decode())
+
+    return status_line.decode(), status_code, header_lines
+
+
+def _header_value(header_lines, name):
+    """Get value of (first) header with given lower-cased name, or None."""
+
+    for line in header_lines:
+        key, value = line.split(":", maxsplit=1)
+        if key.lower().strip() == name:
+            return value.strip()
+
+    return None
+
+
+def _validator(header_lines):
+    """Get validator of response's body usable in If-Range, or None.
+
+    That's strong ETag or, without it, Last-Modified date.
+
+    """
+
+    etag = _header_value(header_lines, "etag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+
+    return _header_value(header_lines, "last-modified")
+
+
+def _segment_request(headers, start, stop, if_range=None):
+    """Rewrite relayed request for fetching bytes ``[start, stop)`` only.
+
+    :param str headers: request line and headers as relayed to remote server
+    :param int start: first byte of the segment
+    :param int stop: first byte after the segment
+    :param str if_range: optional validator of the body, segment is requested
+                         only if it still matches
+    :returns: encoded request
+
+    """
+
+    request_line, *header_lines = headers.splitlines(keepends=True)
+    request = request_line
+    for line in header_lines:
+        key = line.split(":", maxsplit=1)[0].lower().strip()
+        if key not in ("range", "connection") \
+                and not (key == "if-range" and if_range is not None):
+            request += line
+
+    request += "Range: bytes={}-{}\r\n".format(start, stop - 1)
+    if if_range is not None:
+        request += "If-Range: {}\r\n".format(if_range)
+    request += "Connection: close\r\n\r\n"
+    return request.encode()
+
+
+def _segmented_spans(bytes_ranges, length):
+    """Get spans of body wanted by client.
+
+    :param werkzeug.datastructures.Ranges bytes_ranges: optional ranges
+                                                        specification
+    :param int length: length of whole response body
+    :returns: list of ``(start, stop)`` tuples or None, if any range is not
+              satisfiable
+
+    """
+
+    if not bytes_ranges:
+        return [(0, length)]
+
+    spans = []
+    for start, stop in bytes_ranges.ranges:
+        if start < 0:
+            # "last N bytes" range.
+            start, stop = max(length + start, 0), length
+        elif stop is None or stop > length:
+            stop = length
+
+        if start >= stop:
+            return None
+
+        spans.append((start, stop))
+
+    return spans
+
+
+async def _fetch_segment(host, port, failures, headers, start, stop,
+                         validator=None, stats=None):
+    """Fetch bytes ``[start, stop)`` of response body with Range sub-request.
+
+    Segment may be cut short by the end of the body.
+
+    :param str validator: optional validator (see ``_validator``) the body
+                          must still have, so segments of different versions
+                          of it aren't mixed
+    :param Stats stats: optional stats object, accounting the sub-request's
+                        connection
+    :returns: ``(header_lines, data)`` - response's header lines and fetched
+              bytes
+    :raises ConnectionError: when remote server didn't return the requested
+                             range (of the body with given validator)
+
+    """
+
+    remote_reader, remote_writer = await open_remote_connection(
+        host, port, failures)
+    if stats is not None:
+        stats.sub_request_connections += 1
+    try:
+        remote_writer.write(_segment_request(headers, start, stop, validator))
+        await remote_writer.drain()
+
+        _, status_code, header_lines = await _read_response_head(
+            remote_reader)
+        content_range = werkzeug.http.parse_content_range_header(
+            _header_value(header_lines, "content-range"))
+        if status_code != 206 or content_range is None \
+                or content_range.start != start or content_range.stop > stop:
+            raise ConnectionError(
+                "Segment {}-{} not returned by remote server"
+                .format(start, stop - 1))
+        if validator is not None and _validator(header_lines) != validator:
+            raise ConnectionError(
+                "Body changed while fetching segment {}-{}"
+                .format(start, stop - 1))
+
+        data = await remote_reader.readexactly(content_range.stop - start)
+        return header_lines, data
+    finally:
+        remote_writer.close()
+        if stats is not None:
+            stats.sub_request_connections -= 1
+
+
+class _PrefixedReader:
+    """Reader stream wrapper returning already read data first."""
+
+    def __init__(self, prefix, reader):
+        self.prefix = prefix
+        self.reader = reader
+
+    async def readline(self):
+        if not self.prefix:
+            return await self.reader.readline()
+
+        end = self.prefix.find(b"\n") + 1 or len(self.prefix)
+        line, self.prefix = self.prefix[:end], self.prefix[end:]
+        return line
+
+    async def read(self, n=-1):
+        if not self.prefix:
+            return await self.reader.read(n)
+
+        data = self.prefix if n < 0 else self.prefix[:n]
+        self.prefix = self.prefix[len(data):]
+        return data
+
+
+async def relay_segmented_to_client(client, stats, host, port, headers,
+                                    bytes_ranges, failures, compress=False):
+    """Relay GET response fetched with concurrent Range sub-requests.
+
+    First segment is fetched alone to learn whether remote server handles
+    ranges and how long the whole body is. If it doesn't, its response to
+    the first sub-request is relayed as it is (see ``relay_to_client``), not
+    to request it twice. Then wanted spans of the body are
+    split into ``SEGMENT_SIZE`` segments, fetched by up to
+    ``SEGMENT_CONCURRENCY`` sub-requests at once and relayed in order. At most
+    ``SEGMENT_CONCURRENCY`` segments are held in memory at any time.
+
+    Segments are requested with ``If-Range`` validator of the first one. If
+    the body changes meanwhile, relaying is cut instead of mixing its
+    versions.
+
+    Multiple ranges are relayed one after another, like
+    ``_relay_ranged_body_to_client`` does.
+
+    :param asyncio.StreamWriter client: proxy's client writer stream
+    :param Stats stats: stats object
+    :param str host: remote server's host
+    :param int port: remote server's port
+    :param str headers: request line and headers as relayed to remote server
+    :param werkzeug.datastructures.Ranges bytes_ranges: optional ranges
+                                                        specification
+    :param AddressFailureCache failures: cache of failed addresses
+    :param bool compress: whether client accepts gzip-compressed response
+    :returns: False if nothing was relayed and response should be relayed as
+              single stream instead (e.g. whole body's length is unknown),
+              True otherwise
+
+    """
+
+    # Fetch first segment of the first range (or of the whole body).
+    probe_start = 0
+    probe_stop = SEGMENT_SIZE
+    if bytes_ranges and bytes_ranges.ranges[0][0] >= 0:
+        probe_start, probe_stop = bytes_ranges.ranges[0]
+        probe_stop = min(probe_stop or float("inf"),
+                         probe_start + SEGMENT_SIZE)
+
+    try:
+        remote_reader, remote_writer = await open_remote_connection(
+            host, port, failures)
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    stats.sub_request_connections += 1
+    try:
+        remote_writer.write(_segment_request(headers, probe_start, probe_stop))
+        await remote_writer.drain()
+
+        status_line, status_code, header_lines = await asyncio.wait_for(
+            _read_response_head(remote_reader), SEGMENT_TIMEOUT)
+        if status_code == 416:
+            # Range of the probe (not necessarily the client's) not
+            # satisfiable, e.g. for empty body.
+            return False
+        elif status_code != 206:
+            # Remote server doesn't handle ranges - relay its response,
+            # instead of requesting it again.
+            remote = _PrefixedReader(
+                (status_line + "".join(header_lines) + "\r\n").encode(),
+                remote_reader)
+            try:
+                await relay_to_client(remote, client, stats, bytes_ranges,
+                                      compress)
+            except (OSError, EOFError, ValueError) as e:
+                # Response may be already partially relayed.
+                print("Relaying from {}:{} failed: {}".format(host, port, e))
+            return True
+
+        # Without whole body's length segments can't be planned.
+        content_range = werkzeug.http.parse_content_range_header(
+            _header_value(header_lines, "content-range"))
+        if content_range is None or content_range.length is None:
+            return False
+
+        spans = _segmented_spans(bytes_ranges, content_range.length)
+        if spans is None:
+            return False
+
+        probe = (content_range.start, content_range.stop)
+        validator = _validator(header_lines)
+        probe_data = await asyncio.wait_for(
+            remote_reader.readexactly(probe[1] - probe[0]), SEGMENT_TIMEOUT)
+    except (OSError, EOFError, ValueError, asyncio.TimeoutError):
+        return False
+    finally:
+        remote_writer.close()
+        stats.sub_request_connections -= 1
+
+    # Relay response head: status and headers of the probe response, with
+    # framing headers rewritten for the whole relayed body.
+    if bytes_ranges:
+        head = "HTTP/1.1 206 Partial Content\r\n"
+    else:
+        head = "HTTP/1.1 200 OK\r\n"
+    for line in header_lines:
+        key = line.split(":", maxsplit=1)[0].lower().strip()
+        if key not in ("content-length", "content-range", "transfer-encoding",
+                       "connection"):
+            head += line
+    head += "Content-Length: {}\r\n".format(
+        sum(stop - start for start, stop in spans))
+    if bytes_ranges and len(spans) == 1:
+        head += "Content-Range: bytes {}-{}/{}\r\n".format(
+            spans[0][0], spans[0][1] - 1, content_range.length)
+    head += "Connection: close\r\n\r\n"
+
+    stats.total_bytes_transferred += len(head)
+    client.write(head.encode())
+    await client.drain()
+
+    # Segments in order of relaying, reusing already fetched probe.
+    segments = iter([(start, min(start + SEGMENT_SIZE, stop))
+                     for span_start, stop in spans
+                     for start in range(span_start, stop, SEGMENT_SIZE)])
+
+    # Fetches in order of segments - both running and finished ones, waiting
+    # for their turn (reorder buffer).
+    pending = collections.deque()
+
+    def fetch_next():
+        for start, stop in itertools.islice(segments, 1):
+            if (start, stop) == probe:
+                future = asyncio.Future()
+                future.set_result((header_lines, probe_data))
+            else:
+                future = asyncio.ensure_future(asyncio.wait_for(
+                    _fetch_segment(host, port, failures, headers, start, stop,
+                                   validator, stats),
+                    SEGMENT_TIMEOUT))
+            pending.append(future)
+
+    for _ in range(SEGMENT_CONCURRENCY):
+        fetch_next()
+
+    try:
+        while pending:
+            _, data = await pending.popleft()
+            fetch_next()
+
+            # Update stats.
+            stats.total_bytes_transferred += len(data)
+
+            # Send data to the client, wait for the writer to flush.
+            client.write(data)
+            await client.drain()
+    except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+        # Response is already partially relayed - all we can do is to cut it.
+        print("Segmented fetch from {}:{} failed: {}".format(host, port, e))
+    finally:
+        for future in pending:
+            future.cancel()
+
+    return True
+
+
+async def relay_prefetched_to_client(client, stats, header_lines, data):
+    """Relay prefetched segment as 206 response.
+
+    :param asyncio.StreamWriter client: proxy's client writer stream
+    :param Stats stats: stats object
+    :param list header_lines: header lines of segment's response
+    :param bytes data: segment's data
+
+    """
+
+    head = "HTTP/1.1 206 Partial Content\r\n"
+    for line in header_lines:
+        key = line.split(":", maxsplit=1)[0].lower().strip()
+        if key not in ("content-length", "transfer-encoding", "connection"):
+            head += line
+    head += "Content-Length: {}\r\n".format(len(data))
+    head += "Connection: close\r\n\r\n"
+
+    # Update stats.
+    stats.total_bytes_transferred += len(head) + len(data)
+
+    # Send data to the client, wait for the writer to flush.
+    client.write(head.encode())
+    client.write(data)
+    await client.drain()
+
+
+async def _respond_with_status(client, status_line):
+    """Send body-less response with given status and close the stream.
+
+    :param asyncio.StreamWriter client: proxy's client writer stream
+    :param bytes status_line: e.g. ``b"HTTP/1.1 502 Bad Gateway"``
+
+    """
+
+    client.write(status_line + b"\r\nContent-Length: 0\r\n\r\n")
+    await client.drain()
+    client.close()
+
+
+async def on_connected(client_reader, client_writer, listen_on, stats,
+                       failures=None, prefetcher=None, connections=None,
+                       capture=None, h2c_pool=None):
+    # Account the connection, for introspection.
+    connection = Connection(client_writer)
+    if connections is not None:
+        connections.add(connection)
+
+    try:
+        await _handle_connection(client_reader, connection, listen_on, stats,
+                                 failures, prefetcher, connections, capture,
+                                 h2c_pool)
+    finally:
+        # Also on errors (e.g. malformed request) - close both connections,
+        # which also stops accounting the client's one.
+        connection.client.close()
+        if connection.remote is not None:
+            connection.remote.close()
+
+
+async def _handle_connection(client_reader, connection, listen_on, stats,
+                             failures, prefetcher, connections, capture,
+                             h2c_pool):
+    client_writer = connection.client
+
     # Try to read first line of the HTTP request.
     line = await client_reader.readline()
 
@@ -278,17 +1127,24 @@ async def on_connected(client_reader, client_writer, listen_on, stats):
         client_writer.close()
         return
 
-    # For GET /stats. Since it's the only endpoint, basic parsing should
-    # suffice (instead of more sophisticated routing).
+    # For GET /stats and GET /debug/connections. Since these are the only
+    # endpoints, basic parsing should suffice (instead of more sophisticated
+    # routing).
     line = line.decode()
     data = line.split()
     url = urllib.parse.urlparse(data[1])
-    # If GET /stats, return JSON-ed stats dict, wait for writer to flush
-    # and close the connection.
-    if data[0].lower() == "get" and url.path == "/stats":
-        # Get statistics from stats object, serialize it to JSON, encode to
-        # bytes, send as minimal HTTP response and close the stream.
-        data = json.dumps(stats.dictionary).encode()
+    # If GET /stats (or /debug/connections), return JSON-ed stats (or
+    # connections) dict, wait for writer to flush and close the connection.
+    if data[0].lower() == "get" and (
+            url.path == "/stats"
+            or url.path == "/debug/connections" and connections is not None):
+        # Get statistics from stats (or connections) object, serialize it to
+        # JSON, encode to bytes, send as minimal HTTP response and close the
+        # stream.
+        if url.path == "/stats":
+            data = json.dumps(stats.dictionary).encode()
+        else:
+            data = json.dumps(connections.dictionary).encode()
         client_writer.write(b"HTTP/1.1 200 OK\r\n")
         client_writer.write(b"Content-Length: %d\r\n" % len(data))
         client_writer.write(b"Content-Type: application/json\r\n\r\n")
@@ -298,6 +1154,15 @@ async def on_connected(client_reader, client_writer, listen_on, stats):
         client_writer.close()
         return
 
+    # Reject new requests while draining before shutdown.
+    if stats.draining:
+        client_writer.write(b"HTTP/1.1 503 Service Unavailable\r\n"
+                            b"Content-Length: 0\r\n"
+                            b"Connection: close\r\n\r\n")
+        await client_writer.drain()
+        client_writer.close()
+        return
+
     # Parse the query part for range handling.
     query = urllib.parse.parse_qs(url.query)
     query_ranges = None
@@ -310,6 +1175,8 @@ async def on_connected(client_reader, client_writer, listen_on, stats):
     host = None
     port = 80
     bytes_ranges = None
+    request_body = False
+    gzip_accepted = False
     while True:
         line = await client_reader.readline()
 
@@ -332,6 +1199,12 @@ async def on_connected(client_reader, client_writer, listen_on, stats):
                 host = value
         elif key == "range":
             bytes_ranges = werkzeug.http.parse_range_header(value)
+        elif key == "transfer-encoding" \
+                or key == "content-length" and value != "0":
+            request_body = True
+        elif key == "accept-encoding":
+            accept_encoding = werkzeug.http.parse_accept_header(value)
+            gzip_accepted = accept_encoding["gzip"] > 0
         headers += line
 
     if query_ranges and bytes_ranges:
@@ -360,19 +1233,130 @@ async def on_connected(client_reader, client_writer, listen_on, stats):
         client_writer.close()
         return
 
+    if failures is None:
+        failures = AddressFailureCache()
+
+    connection.host = host
+    connection.port = port
+
+    if capture is not None:
+        capture.record(connection, headers, bytes_ranges)
+
+    # Compressed response is chunked, thus for HTTP/1.1 clients only. Bodies
+    # of responses to HEAD don't follow.
+    compress = COMPRESSION and gzip_accepted and data[-1] == "HTTP/1.1" \
+        and data[0].lower() != "head"
+
+    # Requests to h2c remote servers are multiplexed over few connections.
+    if h2c_pool is not None and (host, port) in h2c_pool.backends:
+        print("Proxying to {}:{} over h2c".format(host, port))
+        connection.phase = "h2c"
+        request_lines = headers.splitlines(keepends=True)[1:]
+
+        # Request body is relayed as long as Content-Length says.
+        if _header_value(request_lines, "transfer-encoding"):
+            await _respond_with_status(client_writer,
+                                       b"HTTP/1.1 411 Length Required")
+            return
+        content_length = _header_value(request_lines, "content-length")
+        if content_length is not None and not content_length.isdigit():
+            await _respond_with_status(client_writer,
+                                       b"HTTP/1.1 400 Bad Request")
+            return
+
+        try:
+            stream = await h2c_pool.request(
+                host, port, failures, _h2c_request_headers(headers),
+                end_stream=not request_body)
+        except asyncio.TimeoutError:
+            await _respond_with_status(client_writer,
+                                       b"HTTP/1.1 504 Gateway Timeout")
+            return
+        except OSError:
+            await _respond_with_status(client_writer,
+                                       b"HTTP/1.1 502 Bad Gateway")
+            return
+
+        try:
+            if request_body:
+                await stream.send_body(client_reader, int(content_length))
+            await relay_to_client(stream, client_writer, stats, bytes_ranges,
+                                  compress)
+            await client_writer.drain()
+        except (OSError, EOFError):
+            pass
+        finally:
+            stream.close()
+
+        client_writer.close()
+        return
+
+    # Serve single ranges of objects walked sequentially from read-ahead.
+    # Prefetched segments are shared between clients, thus only for requests
+    # without credentials.
+    request_lines = headers.splitlines(keepends=True)[1:]
+    private = any(_header_value(request_lines, name) is not None
+                  for name in PREFETCH_PRIVATE_HEADERS)
+    if prefetcher is not None and data[0].lower() == "get" \
+            and not request_body and not private and bytes_ranges \
+            and len(bytes_ranges.ranges) == 1 \
+            and bytes_ranges.ranges[0][0] >= 0 \
+            and bytes_ranges.ranges[0][1] is not None:
+        start, stop = bytes_ranges.ranges[0]
+        client = (client_writer.get_extra_info("peername") or ("",))[0]
+        # Object is identified by URL without range query parameter.
+        query = urllib.parse.urlencode(
+            [(key, value)
+             for key, value in urllib.parse.parse_qsl(url.query)
+             if key != "range"])
+        target = (host, port, url._replace(query=query).geturl())
+
+        for segment_start, segment_stop in prefetcher.access(
+                client, target, start, stop):
+            asyncio.ensure_future(prefetcher.fetch(
+                host, port, failures, headers, target,
+                segment_start, segment_stop))
+
+        connection.phase = "prefetch"
+        segment = await prefetcher.get(target, start, stop)
+        if segment is not None:
+            print("Serving prefetched {}:{}".format(host, port))
+            await relay_prefetched_to_client(client_writer, stats, *segment)
+            client_writer.close()
+            return
+
+    # Body-less GETs may be fetched in concurrent segments, if remote server
+    # handles ranges.
+    if SEGMENT_CONCURRENCY > 1 and data[0].lower() == "get" \
+            and not request_body:
+        print("Proxying to {}:{} in segments".format(host, port))
+        connection.phase = "segmented"
+        if await relay_segmented_to_client(client_writer, stats, host, port,
+                                           headers, bytes_ranges, failures,
+                                           compress):
+            await client_writer.drain()
+            client_writer.close()
+            return
+
     try:
         print("Proxying to {}:{}".format(host, port))
+        connection.phase = "connecting"
         # Open connection to remote server.
-        remote_reader, remote_writer = await asyncio.open_connection(
-            host=host,
-            port=port,
-            loop=loop,
-        )
-    except OSError as e:
-        # That spans ConnectionRefusedError, too.
-        client_writer.close()
+        remote_reader, remote_writer = await open_remote_connection(
+            host, port, failures)
+    except asyncio.TimeoutError:
+        await _respond_with_status(client_writer,
+                                   b"HTTP/1.1 504 Gateway Timeout")
+        return
+    except OSError:
+        # That spans ConnectionRefusedError and name resolution errors, too.
+        await _respond_with_status(client_writer, b"HTTP/1.1 502 Bad Gateway")
         return
 
+    connection.phase = "relaying"
+    connection.remote = CountingWriter(remote_writer)
+    remote_writer = connection.remote
+
     # Relay request headers to remote server.
     headers += "\r\n"
     remote_writer.write(headers.encode())
@@ -380,14 +1364,14 @@ async def on_connected(client_reader, client_writer, listen_on, stats):
 
     # Relay bodies of both request and response.
     await asyncio.wait(
-        [loop.create_task(relay_to_client(remote_reader,
-                                          client_writer,
-                                          stats,
-                                          bytes_ranges)),
-         loop.create_task(relay_to_remote(client_reader,
-                                          remote_writer)),
-         ],
-        loop=loop)
+        [asyncio.ensure_future(relay_to_client(remote_reader,
+                                               client_writer,
+                                               stats,
+                                               bytes_ranges,
+                                               compress)),
+         asyncio.ensure_future(relay_to_remote(client_reader,
+                                               remote_writer)),
+         ])
 
     # Wait for client's stream to flush, then close both connections.
     await client_writer.drain()
@@ -398,8 +1382,21 @@ async def on_connected(client_reader, client_writer, listen_on, stats):
 class Stats:
     def __init__(self):
         self.total_bytes_transferred = 0
+        self.compression_bytes_saved = 0
+        self.prefetch_segments = 0
+        self.prefetch_hits = 0
+        self.prefetch_wasted_bytes = 0
+        self.drain_deadline = None  # Set when draining before shutdown.
+        self.drain_connections = 0
+        # Open connections of Range sub-requests (segmented fetching and
+        # prefetching), for introspection.
+        self.sub_request_connections = 0
         self.start_time = time.time()
 
+    @property
+    def draining(self):
+        return self.drain_deadline is not None
+
     @property
     def dictionary(self):
         "Statistics as dictionary with structured uptime."
@@ -412,6 +1409,16 @@ class Stats:
 
         return {
             "total_bytes_transferred": self.total_bytes_transferred,
+            "compression_bytes_saved": self.compression_bytes_saved,
+            "prefetch_segments": self.prefetch_segments,
+            "prefetch_hits": self.prefetch_hits,
+            "prefetch_hit_rate": (self.prefetch_hits / self.prefetch_segments
+                                  if self.prefetch_segments else 0),
+            "prefetch_wasted_bytes": self.prefetch_wasted_bytes,
+            "draining": ({
+                "connections": self.drain_connections,
+                "remaining": max(int(self.drain_deadline - time.time()), 0),
+            } if self.draining else None),
             "uptime": {
                 "days": int(days),
                 "hours": int(hours),
@@ -421,6 +1428,967 @@ class Stats:
         }
 
 
+class AddressFailureCache:
+    """Short-lived memory of addresses which failed to connect."""
+
+    def __init__(self, ttl=FAILED_ADDRESS_TTL):
+        self.ttl = ttl
+        # Socket address -> expiration time, in order of expiration.
+        self._expires = collections.OrderedDict()
+
+    def add(self, sockaddr):
+        now = time.monotonic()
+        self._expires.pop(sockaddr, None)
+        self._expires[sockaddr] = now + self.ttl
+
+        # Forget expired failures of addresses not tried since - hosts are
+        # picked by clients, so these would pile up.
+        while next(iter(self._expires.values())) <= now:
+            self._expires.popitem(last=False)
+
+    def __len__(self):
+        return len(self._expires)
+
+    def __contains__(self, sockaddr):
+        expires = self._expires.get(sockaddr)
+        if expires is None:
+            return False
+
+        # Forget expired failure, so the address gets tried again.
+        if expires <= time.monotonic():
+            del self._expires[sockaddr]
+            return False
+
+        return True
+
+
+class Prefetcher:
+    """Read-ahead of ranges for clients walking objects sequentially.
+
+    Object is walked sequentially when each requested range starts right after
+    the previous one. After ``PREFETCH_TRIGGER`` such requests, next
+    ``segments`` ranges of the same size are prefetched into a store, bounded
+    by ``store_size`` bytes, from which the following requests are served.
+
+    """
+
+    def __init__(self, stats, segments=PREFETCH_SEGMENTS,
+                 store_size=PREFETCH_STORE_SIZE):
+        self.stats = stats
+        self.segments = segments
+        self.store_size = store_size
+        # (client, target) -> (next expected start, number of sequential
+        # requests).
+        self._walks = collections.OrderedDict()
+        # (target, start, stop) -> (expiration time, header lines, data), in
+        # order of expiration.
+        self._store = collections.OrderedDict()
+        self._store_bytes = 0
+        # (target, start, stop) -> future of running fetch.
+        self._fetching = {}
+
+    def access(self, client, target, start, stop):
+        """Track requested range, get segments to prefetch.
+
+        :param str client: client's address
+        :param tuple target: ``(host, port, url)`` of the object
+        :param int start: first byte of the range
+        :param int stop: first byte after the range
+        :returns: list of ``(start, stop)`` segments not stored nor being
+                  fetched yet
+
+        """
+
+        next_start, count = self._walks.pop((client, target), (None, 0))
+        count = count + 1 if start == next_start else 1
+        self._walks[(client, target)] = (stop, count)
+
+        # Forget least recently walked objects.
+        while len(self._walks) > PREFETCH_WALKS:
+            self._walks.popitem(last=False)
+
+        if count < PREFETCH_TRIGGER:
+            return []
+
+        size = stop - start
+        segments = [(stop + i * size, stop + (i + 1) * size)
+                    for i in range(self.segments)]
+        return [(segment_start, segment_stop)
+                for segment_start, segment_stop in segments
+                if (target, segment_start, segment_stop) not in self._store
+                and (target, segment_start, segment_stop)
+                not in self._fetching]
+
+    async def fetch(self, host, port, failures, headers, target, start, stop):
+        """Prefetch segment into the store, ignoring failures."""
+
+        key = (target, start, stop)
+        future = asyncio.ensure_future(asyncio.wait_for(
+            _fetch_segment(host, port, failures, headers, start, stop,
+                           stats=self.stats),
+            SEGMENT_TIMEOUT))
+        self._fetching[key] = future
+        try:
+            header_lines, data = await future
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError):
+            return
+        finally:
+            del self._fetching[key]
+
+        self.stats.prefetch_segments += 1
+        self._evict_expired()
+        self._store[key] = (time.monotonic() + PREFETCH_TTL, header_lines,
+                            data)
+        self._store_bytes += len(data)
+
+        # Evict oldest segments - these were never used.
+        while self._store_bytes > self.store_size:
+            _, (_, _, data) = self._store.popitem(last=False)
+            self._store_bytes -= len(data)
+            self.stats.prefetch_wasted_bytes += len(data)
+
+    async def get(self, target, start, stop):
+        """Take prefetched segment out of the store.
+
+        Waits for the segment, if it's being fetched.
+
+        :returns: ``(header_lines, data)`` or None
+
+        """
+
+        key = (target, start, stop)
+        if key in self._fetching:
+            # Don't let cancellation of the request cancel the prefetch.
+            await asyncio.wait([self._fetching[key]])
+
+        self._evict_expired()
+        if key not in self._store:
+            return None
+
+        expires, header_lines, data = self._store.pop(key)
+        self._store_bytes -= len(data)
+        if expires <= time.monotonic():
+            self.stats.prefetch_wasted_bytes += len(data)
+            return None
+
+        self.stats.prefetch_hits += 1
+        return header_lines, data
+
+    def _evict_expired(self):
+        # Segments of objects clients stopped walking - these were never used.
+        now = time.monotonic()
+        while self._store and next(iter(self._store.values()))[0] <= now:
+            _, (_, _, data) = self._store.popitem(last=False)
+            self._store_bytes -= len(data)
+            self.stats.prefetch_wasted_bytes += len(data)
+
+
+class CountingWriter:
+    """Stream writer wrapper counting bytes written through it.
+
+    Also keeps the head (status line and headers) of the written response.
+
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.bytes_written = 0
+        self.head = None  # Set once whole head is written.
+        self._head_buffer = bytearray()
+        self.closed = False
+        self.close_callbacks = []  # Called once, on close.
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        if self.head is None and len(self._head_buffer) < MAX_HEAD_SIZE:
+            self._head_buffer += data[:MAX_HEAD_SIZE - len(self._head_buffer)]
+            end = self._head_buffer.find(b"\r\n\r\n")
+            if end != -1:
+                self.head = bytes(self._head_buffer[:end + 4])
+                self._head_buffer = bytearray()
+        self.writer.write(data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+        if not self.closed:
+            self.closed = True
+            for callback in self.close_callbacks:
+                callback()
+
+    def get_extra_info(self, name, default=None):
+        return self.writer.get_extra_info(name, default)
+
+    @property
+    def buffer_size(self):
+        "Size of data written, but not yet sent [bytes]."
+
+        transport = getattr(self.writer, "transport", None)
+        if transport is None:
+            return 0
+
+        return transport.get_write_buffer_size()
+
+
+class Connection:
+    """Client connection's state, for introspection."""
+
+    def __init__(self, client_writer):
+        self.client = CountingWriter(client_writer)
+        self.remote = None  # Writer of connection to remote server, if any.
+        self.phase = "request"
+        self.host = None
+        self.port = None
+        self.start_time = time.monotonic()
+
+    @property
+    def dictionary(self):
+        "Connection's state as dictionary."
+
+        peername = self.client.get_extra_info("peername")
+        return {
+            "phase": self.phase,
+            "age": round(time.monotonic() - self.start_time, 3),
+            "client": "{}:{}".format(*peername[:2]) if peername else None,
+            "host": ("{}:{}".format(self.host, self.port)
+                     if self.host else None),
+            "bytes_to_client": self.client.bytes_written,
+            "bytes_to_remote": (self.remote.bytes_written
+                                if self.remote else 0),
+            "client_buffer_size": self.client.buffer_size,
+            "remote_buffer_size": (self.remote.buffer_size
+                                   if self.remote else 0),
+        }
+
+
+def _rss():
+    """Resident set size of the process [bytes] or None, if unknown."""
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Connections:
+    """Registry of active client connections, for introspection.
+
+    Connections to remote servers not belonging to a single client
+    connection are accounted by stats object (Range sub-requests) and h2c
+    pool.
+
+    """
+
+    def __init__(self, stats=None, h2c_pool=None):
+        self.stats = stats
+        self.h2c_pool = h2c_pool
+        self._active = {}  # id() of connection -> connection.
+
+    def add(self, connection):
+        """Track connection until its client's stream is closed."""
+
+        self._active[id(connection)] = connection
+        connection.client.close_callbacks.append(functools.partial(
+            self._active.pop, id(connection), None))
+
+    def __len__(self):
+        return len(self._active)
+
+    @property
+    def proxying(self):
+        "Number of connections past reading their request."
+
+        return sum(1 for connection in self._active.values()
+                   if connection.phase != "request")
+
+    @property
+    def dictionary(self):
+        "Active connections and process-wide totals as dictionary."
+
+        connections = [connection.dictionary
+                       for connection in self._active.values()]
+
+        # asyncio.Task.all_tasks() before Python 3.7.
+        all_tasks = getattr(asyncio, "all_tasks", None) \
+            or asyncio.Task.all_tasks
+
+        memory = None
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            memory = {"current": current, "peak": peak}
+
+        remote_connections = {
+            "relaying": sum(1 for connection in self._active.values()
+                            if connection.remote is not None
+                            and not connection.remote.closed),
+            "sub_requests": (self.stats.sub_request_connections
+                             if self.stats is not None else 0),
+            "h2c": (self.h2c_pool.open_connections
+                    if self.h2c_pool is not None else 0),
+        }
+
+        return {
+            "connections": connections,
+            "totals": {
+                "connections": len(connections),
+                "remote_connections": sum(remote_connections.values()),
+                "remote_connections_by_mode": remote_connections,
+                "tasks": len(all_tasks()),
+                "bytes_buffered": sum(
+                    connection["client_buffer_size"]
+                    + connection["remote_buffer_size"]
+                    for connection in connections),
+                "rss": _rss(),
+                "tracemalloc": memory,
+            },
+        }
+
+
+def _object_size(head):
+    """Get size of whole object from response head, or None if unknown.
+
+    :param bytes head: status line and headers of response sent to client
+
+    """
+
+    status_line, *header_lines = head.decode("latin-1").split("\r\n")
+    header_lines = [line for line in header_lines if ":" in line]
+
+    content_range = werkzeug.http.parse_content_range_header(
+        _header_value(header_lines, "content-range"))
+    if content_range is not None:
+        return content_range.length
+
+    # Partial content without Content-Range - multiple ranges.
+    content_length = _header_value(header_lines, "content-length")
+    if status_line.split()[1:2] == ["200"] and content_length \
+            and content_length.isdigit():
+        return int(content_length)
+
+    return None
+
+
+class Capture:
+    """Sampled capture of requests' metadata to JSON lines file.
+
+    Each line describes one request: its time, method, remote server, target,
+    headers (with credentials redacted), ranges and body size, and once the
+    client's stream is closed, duration, number of bytes sent to client (in
+    total and of response body) and size of the whole requested object, if
+    known from response headers. Captured traffic can be replayed with
+    ``replay.py``.
+
+    """
+
+    def __init__(self, path, sample_rate=CAPTURE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        # Line buffered - each record is written once complete.
+        self._file = open(path, "a", buffering=1)
+
+    def record(self, connection, headers, bytes_ranges):
+        """Capture request, if sampled.
+
+        :param Connection connection: client connection of the request
+        :param str headers: request line and headers as relayed to remote
+                            server
+        :param werkzeug.datastructures.Ranges bytes_ranges: optional ranges
+                                                            specification
+
+        """
+
+        if random.random() >= self.sample_rate:
+            return
+
+        request_line, *header_lines = headers.splitlines()
+        method, target, *version = request_line.split()
+        captured_headers = []
+        body_size = 0
+        for line in header_lines:
+            key, value = line.split(":", maxsplit=1)
+            key, value = key.strip(), value.strip()
+            if key.lower() in CAPTURE_REDACTED_HEADERS:
+                value = "<redacted>"
+            elif key.lower() == "content-length" and value.isdigit():
+                body_size = int(value)
+            captured_headers.append([key, value])
+
+        record = {
+            "time": time.time() - (time.monotonic() - connection.start_time),
+            "method": method,
+            "host": connection.host,
+            "port": connection.port,
+            "target": target,
+            "headers": captured_headers,
+            "ranges": bytes_ranges.to_header() if bytes_ranges else None,
+            "body_size": body_size,
+        }
+
+        def write():
+            head = connection.client.head or b""
+            record["duration"] = time.monotonic() - connection.start_time
+            record["response_bytes"] = connection.client.bytes_written
+            record["response_body_bytes"] = \
+                connection.client.bytes_written - len(head)
+            record["object_size"] = _object_size(head)
+            self._file.write(json.dumps(record) + "\n")
+
+        connection.client.close_callbacks.append(write)
+
+    def close(self):
+        self._file.close()
+
+
+def _h2c_request_headers(headers):
+    """Translate relayed HTTP/1.1 request to HTTP/2 request headers.
+
+    :param str headers: request line and headers as relayed to remote server
+    :returns: list of ``(name, value)`` tuples, pseudo-headers first
+
+    """
+
+    request_line, *header_lines = headers.splitlines()
+    method, target, *_ = request_line.split()
+    url = urllib.parse.urlparse(target)
+
+    h2_headers = [
+        (":method", method),
+        (":scheme", "http"),
+        (":authority", _header_value(header_lines, "host") or url.netloc),
+        (":path", urllib.parse.urlunparse(
+            ("", "", url.path or "/", url.params, url.query, ""))),
+    ]
+    for line in header_lines:
+        key, value = line.split(":", maxsplit=1)
+        key = key.lower().strip()
+        if key not in H2C_STRIPPED_HEADERS:
+            h2_headers.append((key, value.strip()))
+
+    return h2_headers
+
+
+def _http1_head(h2_headers):
+    """Translate HTTP/2 response headers to HTTP/1.1 status line and headers.
+
+    Response is delimited by closing the connection, unless it has
+    Content-Length.
+
+    :param list h2_headers: ``(name, value)`` tuples of bytes
+    :returns: encoded status line and headers, with the final CRLF
+
+    """
+
+    status = 502
+    head = ""
+    for name, value in h2_headers:
+        name, value = name.decode(), value.decode()
+        if name == ":status":
+            status = int(value)
+        elif not name.startswith(":") and name not in H2C_STRIPPED_HEADERS:
+            name = "-".join(part.capitalize() for part in name.split("-"))
+            head += "{}: {}\r\n".format(name, value)
+
+    try:
+        reason = http.HTTPStatus(status).phrase
+    except ValueError:
+        reason = ""
+
+    return "HTTP/1.1 {} {}\r\n{}Connection: close\r\n\r\n".format(
+        status, reason, head).encode()
+
+
+class H2cStream:
+    """Single request multiplexed over h2c connection.
+
+    Response is read as HTTP/1.1 response, like from
+    ``asyncio.StreamReader``. Consumed response body is acknowledged to remote
+    server, so it sends no more than ``H2C_STREAM_WINDOW`` bytes ahead.
+
+    """
+
+    def __init__(self, connection, stream_id):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.ended = False
+        # Items are (data, flow controlled length) tuples, or None at the end
+        # of the response.
+        self._queue = asyncio.Queue()
+        self._buffer = bytearray()
+        self._eof = False
+        self._head_received = False
+
+    def feed_head(self, h2_headers):
+        self._head_received = True
+        self._queue.put_nowait((_http1_head(h2_headers), 0))
+
+    def feed_data(self, data, length):
+        self._queue.put_nowait((data, length))
+
+    def feed_eof(self):
+        if self.ended:
+            return
+
+        # Stream ended before response's headers - bad gateway.
+        if not self._head_received:
+            self._queue.put_nowait((b"HTTP/1.1 502 Bad Gateway\r\n"
+                                    b"Content-Length: 0\r\n\r\n", 0))
+        self.ended = True
+        self._queue.put_nowait(None)
+
+    async def _fill(self):
+        item = await self._queue.get()
+        if item is None:
+            self._eof = True
+            return
+
+        data, length = item
+        self._buffer += data
+        self.connection.acknowledge(self.stream_id, length)
+
+    async def readline(self):
+        while b"\n" not in self._buffer and not self._eof:
+            await self._fill()
+
+        end = self._buffer.find(b"\n") + 1 or len(self._buffer)
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return line
+
+    async def read(self, n):
+        if not self._buffer and not self._eof:
+            await self._fill()
+
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def send_body(self, client, length):
+        """Relay request body from client and end the request.
+
+        :param asyncio.StreamReader client: proxy's client reader stream
+        :param int length: length of request body
+
+        """
+
+        while length > 0:
+            buf = await client.readexactly(min(length, READ_BUFFER_SIZE))
+            length -= len(buf)
+            await self.connection.send_data(self.stream_id, buf,
+                                            end_stream=length <= 0)
+
+    def close(self):
+        """Reset the stream, if it's still open.
+
+        Response data received, but not consumed, is acknowledged - it still
+        counts for the connection's flow control window.
+
+        """
+
+        length = 0
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                length += item[1]
+
+        self.connection.acknowledge(self.stream_id, length)
+        self.connection.reset(self.stream_id)
+
+
+class H2cConnection:
+    """Prior knowledge HTTP/2 cleartext (h2c) connection to remote server."""
+
+    def __init__(self, reader, writer, on_release):
+        self._reader = reader
+        self._writer = writer
+        self._on_release = on_release  # Called when stream gets released.
+        self._streams = {}  # Stream ID -> H2cStream.
+        self._window_updated = asyncio.Event()
+        # Until remote server's settings arrive, its limit of concurrent
+        # streams is unknown.
+        self._settings_received = False
+        # False once remote server sent GOAWAY - streams already open may
+        # still finish, but no new ones may be opened.
+        self.accepting_streams = True
+        self.closed = False  # Transport closed.
+
+        self._h2 = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=True, header_encoding=None))
+        self._h2.initiate_connection()
+        self._h2.update_settings({
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: H2C_STREAM_WINDOW,
+        })
+        self._h2.increment_flow_control_window(
+            H2C_CONNECTION_WINDOW - self._h2.inbound_flow_control_window)
+        self._flush()
+
+        self._receiving = asyncio.ensure_future(self._receive())
+
+    @property
+    def available_streams(self):
+        "Number of streams which may be opened now."
+
+        if self.closed or not self.accepting_streams \
+                or not self._settings_received:
+            return 0
+
+        return self._h2.remote_settings.max_concurrent_streams \
+            - self._h2.open_outbound_streams
+
+    def _flush(self):
+        data = self._h2.data_to_send()
+        if data:
+            self._writer.write(data)
+
+    def _release(self, stream_id):
+        stream = self._streams.pop(stream_id, None)
+        if stream is not None:
+            stream.feed_eof()
+            self._on_release()
+
+        if not self.accepting_streams and not self._streams:
+            # Last stream finished after GOAWAY - the connection is useless.
+            self._writer.close()
+
+    async def request(self, h2_headers, end_stream):
+        """Open stream sending request headers.
+
+        :returns: stream of the request
+        :rtype: H2cStream
+        :raises h2.exceptions.TooManyStreamsError: when no stream may be
+                                                   opened now (e.g. another
+                                                   request took the last one)
+        :raises ConnectionError: when the connection is closed
+
+        """
+
+        if self.available_streams <= 0:
+            if self.closed or not self.accepting_streams:
+                raise ConnectionError("h2c connection closed")
+            raise h2.exceptions.TooManyStreamsError(
+                "No h2c stream available")
+
+        stream_id = self._h2.get_next_available_stream_id()
+        try:
+            self._h2.send_headers(stream_id, h2_headers,
+                                  end_stream=end_stream)
+        except h2.exceptions.TooManyStreamsError:
+            raise
+        except h2.exceptions.ProtocolError as e:
+            raise ConnectionError("h2c request failed: {}".format(e))
+
+        stream = H2cStream(self, stream_id)
+        self._streams[stream_id] = stream
+        self._flush()
+        await self._writer.drain()
+        return stream
+
+    async def send_data(self, stream_id, data, end_stream=False):
+        """Send request body data, as remote server's flow control allows."""
+
+        while data:
+            if self.closed or stream_id not in self._streams:
+                raise ConnectionError("h2c stream {} closed".format(stream_id))
+
+            size = min(len(data), self._h2.max_outbound_frame_size,
+                       self._h2.local_flow_control_window(stream_id))
+            if size <= 0:
+                await self._window_updated.wait()
+                continue
+
+            self._h2.send_data(stream_id, data[:size])
+            data = data[size:]
+            self._flush()
+            await self._writer.drain()
+
+        if end_stream:
+            self._h2.end_stream(stream_id)
+            self._flush()
+            await self._writer.drain()
+
+    def acknowledge(self, stream_id, length):
+        """Acknowledge consumed response data, opening flow control window."""
+
+        if length and not self.closed:
+            self._h2.acknowledge_received_data(length, stream_id)
+            self._flush()
+
+    async def close(self):
+        """Close the connection, ending all its streams."""
+
+        self._receiving.cancel()
+        await asyncio.wait([self._receiving])
+
+    def reset(self, stream_id):
+        """Reset stream, if it's still open."""
+
+        if stream_id in self._streams and not self.closed:
+            try:
+                self._h2.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+            except h2.exceptions.StreamClosedError:
+                pass
+            self._flush()
+
+        self._release(stream_id)
+
+    async def _receive(self):
+        try:
+            while True:
+                data = await self._reader.read(READ_BUFFER_SIZE)
+                if not data:
+                    break
+
+                for event in self._h2.receive_data(data):
+                    self._handle(event)
+                self._flush()
+        except (OSError, h2.exceptions.ProtocolError) as e:
+            print("h2c connection failed: {}".format(e))
+        finally:
+            self.closed = True
+            self._writer.close()
+            for stream_id in list(self._streams):
+                self._release(stream_id)
+            self._window_updated.set()
+
+    def _handle(self, event):
+        stream = self._streams.get(getattr(event, "stream_id", None))
+        if isinstance(event, h2.events.ResponseReceived) and stream:
+            stream.feed_head(event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+            if stream:
+                stream.feed_data(event.data, event.flow_controlled_length)
+            else:
+                # Data of already reset stream still counts for connection.
+                self._h2.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, (h2.events.StreamEnded,
+                                h2.events.StreamReset)):
+            self._release(event.stream_id)
+        elif isinstance(event, h2.events.WindowUpdated):
+            # Wake up all senders waiting for the window to open.
+            self._window_updated.set()
+            self._window_updated = asyncio.Event()
+        elif isinstance(event, h2.events.RemoteSettingsChanged):
+            # Maximum number of concurrent streams might have grown.
+            self._settings_received = True
+            self._on_release()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            # GOAWAY - no new streams. Streams above the last one processed
+            # by remote server won't be, at all.
+            self.accepting_streams = False
+            last_stream_id = event.last_stream_id or 0
+            for stream_id in list(self._streams):
+                if stream_id > last_stream_id:
+                    self._release(stream_id)
+
+            if self._streams:
+                # h2 considers the connection closed on GOAWAY, failing on
+                # any further frame. Streams up to the last one may still
+                # complete, though (RFC 9113, section 6.8) - reopen it for
+                # them.
+                self._h2.state_machine.state = \
+                    h2.connection.ConnectionState.CLIENT_OPEN
+            else:
+                self._writer.close()
+
+
+class H2cPool:
+    """Pool of h2c connections to remote servers speaking h2c.
+
+    Requests are multiplexed over up to ``H2C_CONNECTIONS`` connections to
+    each remote server, as long as their concurrent streams limits allow.
+    Otherwise they wait for a stream to be released.
+
+    """
+
+    def __init__(self, backends, max_connections=H2C_CONNECTIONS):
+        self.backends = set(backends)  # (host, port) tuples.
+        self.max_connections = max_connections
+        self._connections = collections.defaultdict(list)
+        self._opening = collections.Counter()
+        self._released = asyncio.Event()
+
+    @property
+    def open_connections(self):
+        "Number of open connections to all remote servers (incl. draining)."
+
+        return sum(1 for connections in self._connections.values()
+                   for connection in connections
+                   if not connection.closed)
+
+    def _notify_released(self):
+        # Wake up all requests waiting for a stream.
+        self._released.set()
+        self._released = asyncio.Event()
+
+    async def _connection(self, host, port, failures):
+        key = (host, port)
+        while True:
+            self._connections[key] = [connection
+                                      for connection in self._connections[key]
+                                      if not connection.closed]
+            # Connections which got GOAWAY only finish their streams.
+            connections = [connection for connection in self._connections[key]
+                           if connection.accepting_streams]
+
+            # Least loaded connection with a stream available.
+            if connections:
+                connection = max(connections,
+                                 key=lambda c: c.available_streams)
+                if connection.available_streams > 0:
+                    return connection
+
+            if len(connections) + self._opening[key] < self.max_connections:
+                self._opening[key] += 1
+                try:
+                    reader, writer = await open_remote_connection(
+                        host, port, failures)
+                finally:
+                    self._opening[key] -= 1
+                    # Requests waiting for this connection retry - on
+                    # failure, they open their own connections (and fail
+                    # fast, too).
+                    self._notify_released()
+
+                connection = H2cConnection(reader, writer,
+                                           self._notify_released)
+                self._connections[key].append(connection)
+                return connection
+
+            await self._released.wait()
+
+    async def request(self, host, port, failures, h2_headers, end_stream):
+        """Send request over h2c connection to remote server.
+
+        :param str host: remote server's host
+        :param int port: remote server's port
+        :param AddressFailureCache failures: cache of failed addresses
+        :param list h2_headers: request headers
+        :param bool end_stream: whether the request has no body
+        :returns: stream of the request
+        :rtype: H2cStream
+        :raises OSError: when connection to remote server fails
+        :raises asyncio.TimeoutError: when no stream gets available in
+                                      ``CONNECT_TIMEOUT``
+
+        """
+
+        async def _request():
+            while True:
+                connection = await self._connection(host, port, failures)
+                try:
+                    return await connection.request(h2_headers, end_stream)
+                except h2.exceptions.TooManyStreamsError:
+                    # Stream taken by another request meanwhile (or remote
+                    # server's limit not known yet) - wait for the next one.
+                    continue
+
+        return await asyncio.wait_for(_request(), CONNECT_TIMEOUT)
+
+    async def close(self):
+        """Close all connections."""
+
+        for connections in self._connections.values():
+            for connection in connections:
+                await connection.close()
+
+
+async def drain(server, connections, stats, close_server=True):
+    """Let active connections finish, for up to ``DRAIN_TIMEOUT``.
+
+    Server stops accepting connections or, if it's left open, proxy requests
+    are rejected with 503 (while /stats reports progress of draining). Only
+    connections already proxying are waited for - not the ones still reading
+    their request, which get rejected or answered right away.
+
+    :param asyncio.AbstractServer server: proxy's server
+    :param Connections connections: registry of active connections
+    :param Stats stats: stats object
+    :param bool close_server: whether to stop accepting connections
+    :returns: number of connections which didn't finish in time
+
+    """
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + DRAIN_TIMEOUT
+    stats.drain_deadline = time.time() + DRAIN_TIMEOUT
+    if close_server:
+        server.close()
+
+    while True:
+        stats.drain_connections = connections.proxying
+        if not stats.drain_connections or loop.time() >= deadline:
+            break
+
+        await asyncio.sleep(DRAIN_POLL_INTERVAL)
+
+    return stats.drain_connections
+
+
+async def spawn_successor(server):
+    """Start new proxy process, handing it over the listening socket.
+
+    Waits for the new process to report it serves the socket, through a pipe
+    it's handed over, too (see ``PROXY_READY_FD_ENV``). If the process exits
+    first (e.g. on bad configuration) or doesn't report in
+    ``SUCCESSOR_TIMEOUT``, it's considered failed.
+
+    :param asyncio.AbstractServer server: proxy's server
+    :returns: new process or None, if it failed to start (it's killed, if
+              still running)
+    :rtype: subprocess.Popen
+    :raises OSError: when new process can't be started at all
+
+    """
+
+    fd = server.sockets[0].fileno()
+    ready_fd, ready_write_fd = os.pipe()
+    env = dict(os.environ)
+    env[PROXY_LISTEN_FD_ENV] = str(fd)
+    env[PROXY_READY_FD_ENV] = str(ready_write_fd)
+    try:
+        successor = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                                     pass_fds=[fd, ready_write_fd])
+    except OSError:
+        os.close(ready_fd)
+        raise
+    finally:
+        # Only the new process holds the pipe's writing end - when it exits,
+        # the pipe gets closed.
+        os.close(ready_write_fd)
+
+    loop = asyncio.get_event_loop()
+    ready = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(ready),
+        os.fdopen(ready_fd, "rb", buffering=0))
+    try:
+        reported = await asyncio.wait_for(ready.read(1), SUCCESSOR_TIMEOUT)
+    except asyncio.TimeoutError:
+        reported = b""
+    finally:
+        transport.close()
+
+    if not reported:
+        if successor.poll() is None:
+            successor.kill()
+            successor.wait()
+        return None
+
+    return successor
+
+
+def notify_ready():
+    """Report to the old process (if any) that the handed over socket is
+    served."""
+
+    if os.environ.get(PROXY_READY_FD_ENV):
+        ready_fd = int(os.environ.pop(PROXY_READY_FD_ENV))
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+
+
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
 
@@ -434,21 +2402,131 @@ if __name__ == "__main__":
     if PROXY_PORT_ENV in os.environ and os.environ[PROXY_PORT_ENV]:
         port = int(os.environ[PROXY_PORT_ENV])
 
+    # Get drain timeout from environment variable, if available.
+    if os.environ.get(PROXY_DRAIN_TIMEOUT_ENV):
+        DRAIN_TIMEOUT = float(os.environ[PROXY_DRAIN_TIMEOUT_ENV])
+
+    # Get comma-separated host:port list of h2c remote servers from
+    # environment variable, if available.
+    h2c_pool = None
+    if os.environ.get(PROXY_H2C_BACKENDS_ENV):
+        if h2 is None:
+            sys.exit("h2c remote servers need h2 package: "
+                     "pip install -e .[h2c]")
+
+        backends = []
+        for backend in os.environ[PROXY_H2C_BACKENDS_ENV].split(","):
+            backend_host, _, backend_port = backend.strip().partition(":")
+            backends.append((backend_host, int(backend_port or 80)))
+        h2c_pool = H2cPool(backends)
+
+    # Get segmented fetching settings from environment variables, if
+    # available.
+    if os.environ.get(PROXY_SEGMENT_CONCURRENCY_ENV):
+        SEGMENT_CONCURRENCY = int(os.environ[PROXY_SEGMENT_CONCURRENCY_ENV])
+
+    if os.environ.get(PROXY_SEGMENT_SIZE_ENV):
+        SEGMENT_SIZE = int(os.environ[PROXY_SEGMENT_SIZE_ENV])
+
+    # Enable compression by environment variable, if available.
+    if os.environ.get(PROXY_COMPRESSION_ENV):
+        COMPRESSION = bool(int(os.environ[PROXY_COMPRESSION_ENV]))
+
+    # Get number of prefetched segments from environment variable, if
+    # available.
+    if os.environ.get(PROXY_PREFETCH_SEGMENTS_ENV):
+        PREFETCH_SEGMENTS = int(os.environ[PROXY_PREFETCH_SEGMENTS_ENV])
+
+    # Get traffic capture settings from environment variables, if available.
+    if os.environ.get(PROXY_CAPTURE_SAMPLE_RATE_ENV):
+        CAPTURE_SAMPLE_RATE = float(os.environ[PROXY_CAPTURE_SAMPLE_RATE_ENV])
+
+    capture = None
+    if os.environ.get(PROXY_CAPTURE_FILE_ENV):
+        capture = Capture(os.environ[PROXY_CAPTURE_FILE_ENV],
+                          CAPTURE_SAMPLE_RATE)
+
     stats = Stats()
-    # "Initialize" callback with listen-on info and statistics object.
+    connections = Connections(stats, h2c_pool)
+    # "Initialize" callback with listen-on info, statistics object, cache of
+    # failed remote addresses, read-ahead, registry of connections, traffic
+    # capture and h2c connections shared between connections.
     on_connected = functools.partial(on_connected,
                                      listen_on=(host, port),
                                      stats=stats,
+                                     failures=AddressFailureCache(),
+                                     prefetcher=(Prefetcher(stats,
+                                                            PREFETCH_SEGMENTS)
+                                                 if PREFETCH_SEGMENTS
+                                                 else None),
+                                     connections=connections,
+                                     capture=capture,
+                                     h2c_pool=h2c_pool,
                                      )
 
-    # Run the server.
+    # Run the server, on listening socket handed over by previous process if
+    # restarted.
     print("Running proxy on {}:{}".format(host, port))
-    server = loop.run_until_complete(asyncio.start_server(
-        on_connected,
-        host,
-        port,
-        loop=loop,
-    ))
+    if os.environ.get(PROXY_LISTEN_FD_ENV):
+        sock = socket.socket(fileno=int(os.environ.pop(PROXY_LISTEN_FD_ENV)))
+        server = loop.run_until_complete(asyncio.start_server(
+            on_connected,
+            sock=sock,
+        ))
+    else:
+        server = loop.run_until_complete(asyncio.start_server(
+            on_connected,
+            host,
+            port,
+        ))
+
+    restarting = asyncio.Lock()
+
+    async def shutdown(restart):
+        """Drain connections and stop the loop.
+
+        On restart, listening socket is handed over to the new process first,
+        so no connections are refused meanwhile. If the new process fails to
+        start, this one keeps serving.
+
+        """
+
+        if stats.draining or restart and restarting.locked():
+            return
+
+        if restart:
+            async with restarting:
+                try:
+                    successor = await spawn_successor(server)
+                except OSError as e:
+                    print("Restart failed: {}".format(e))
+                    return
+
+            if successor is None:
+                print("Restart failed: new process didn't start serving")
+                return
+
+            # Stopped by SIGTERM meanwhile - the new process shouldn't keep
+            # serving either.
+            if stats.draining:
+                successor.terminate()
+                return
+
+            print("Restarting as process {}".format(successor.pid))
+
+        print("Draining {} connections".format(connections.proxying))
+        cut = await drain(server, connections, stats, close_server=restart)
+        print("Drained, {} connections cut".format(cut))
+        loop.stop()
+
+    # Drain and stop the server by SIGTERM, drain and restart by SIGHUP.
+    loop.add_signal_handler(signal.SIGTERM,
+                            lambda: asyncio.ensure_future(shutdown(False)))
+    loop.add_signal_handler(signal.SIGHUP,
+                            lambda: asyncio.ensure_future(shutdown(True)))
+
+    # Serving - report to the old process, if restarted.
+    notify_ready()
 
     # Stop the server by ^C.
     try:
@@ -459,4 +2537,8 @@ if __name__ == "__main__":
     # Cleanup.
     server.close()
     loop.run_until_complete(server.wait_closed())
+    if h2c_pool is not None:
+        loop.run_until_complete(h2c_pool.close())
     loop.close()
+    if capture is not None:
+        capture.close()
@@ -0,0 +1,238 @@
+import argparse
+import asyncio
+import json
+import statistics
+import urllib.parse
+
+import werkzeug.http
+
+
+# Header of replayed requests telling upstream stand-in size of response body
+# to send back.
+RESPONSE_SIZE_HEADER = "X-Replay-Response-Size"
+
+# Header of replayed requests telling upstream stand-in size of the whole
+# requested object, for responding to Range requests.
+OBJECT_SIZE_HEADER = "X-Replay-Object-Size"
+
+# Headers of captured requests which are not replayed as they were.
+REPLACED_HEADERS = ("host", "content-length", "connection",
+                    RESPONSE_SIZE_HEADER.lower(), OBJECT_SIZE_HEADER.lower())
+
+
+async def handle_upstream(reader, writer):
+    """Upstream stand-in: respond to any request with body of requested size.
+
+    Single range of object of known size is responded to with 206 Partial
+    Content, like a range-capable server would.
+
+    :param asyncio.StreamReader reader: proxy's reader stream
+    :param asyncio.StreamWriter writer: proxy's writer stream
+
+    """
+
+    await reader.readline()
+
+    size = 0
+    object_size = None
+    bytes_ranges = None
+    body_size = 0
+    while True:
+        line = await reader.readline()
+
+        # If line's empty or only CRLF - headers (or whole request) ended.
+        if not line or line == b"\r\n":
+            break
+
+        key, value = line.decode().split(":", maxsplit=1)
+        key = key.lower().strip()
+        if key == RESPONSE_SIZE_HEADER.lower():
+            size = int(value)
+        elif key == OBJECT_SIZE_HEADER.lower():
+            object_size = int(value)
+        elif key == "range":
+            bytes_ranges = werkzeug.http.parse_range_header(value.strip())
+        elif key == "content-length":
+            body_size = int(value)
+
+    try:
+        await reader.readexactly(body_size)
+    except asyncio.IncompleteReadError:
+        pass
+
+    status = b"200 OK"
+    range_header = b""
+    if object_size is not None:
+        size = object_size
+
+        # Multiple ranges are left to the proxy to cut.
+        if bytes_ranges and len(bytes_ranges.ranges) == 1:
+            start, stop = bytes_ranges.ranges[0]
+            if start < 0:
+                # "last N bytes" range.
+                start, stop = max(object_size + start, 0), object_size
+            elif stop is None or stop > object_size:
+                stop = object_size
+
+            if start >= stop:
+                status = b"416 Range Not Satisfiable"
+                range_header = b"Content-Range: bytes */%d\r\n" % object_size
+                size = 0
+            else:
+                status = b"206 Partial Content"
+                range_header = b"Content-Range: bytes %d-%d/%d\r\n" % (
+                    start, stop - 1, object_size)
+                size = stop - start
+
+    writer.write(b"HTTP/1.1 " + status + b"\r\n" + range_header)
+    writer.write(b"Content-Type: application/octet-stream\r\n"
+                 b"Content-Length: %d\r\n"
+                 b"Connection: close\r\n\r\n" % size)
+    writer.write(bytes(size))
+    await writer.drain()
+    writer.close()
+
+
+def build_request(record, upstream):
+    """Build request replaying captured one against upstream stand-in.
+
+    :param dict record: captured request
+    :param tuple upstream: ``(host, port)`` of upstream stand-in
+    :returns: encoded request
+
+    """
+
+    url = urllib.parse.urlparse(record["target"])
+    netloc = "{}:{}".format(*upstream)
+    target = urllib.parse.urlunparse(
+        ("http", netloc, url.path or "/", url.params, url.query, ""))
+
+    request = "{} {} HTTP/1.1\r\n".format(record["method"], target)
+    request += "Host: {}\r\n".format(netloc)
+    for key, value in record["headers"]:
+        if key.lower() not in REPLACED_HEADERS:
+            request += "{}: {}\r\n".format(key, value)
+    if record["body_size"]:
+        request += "Content-Length: {}\r\n".format(record["body_size"])
+    # Older captures have no response body size, only the total one.
+    request += "{}: {}\r\n".format(
+        RESPONSE_SIZE_HEADER,
+        record.get("response_body_bytes", record.get("response_bytes", 0)))
+    if record.get("object_size") is not None:
+        request += "{}: {}\r\n".format(OBJECT_SIZE_HEADER,
+                                       record["object_size"])
+    request += "Connection: close\r\n\r\n"
+
+    return request.encode() + bytes(record["body_size"])
+
+
+async def replay(records, proxy, upstream, speed=1.0):
+    """Replay captured requests through proxy, keeping their timing.
+
+    :param list records: captured requests, ordered by time
+    :param tuple proxy: ``(host, port)`` of the proxy
+    :param tuple upstream: ``(host, port)`` of upstream stand-in
+    :param float speed: timing scale - 2 replays twice as fast, 0 sends all
+                        requests at once
+    :returns: list of latencies of requests [s] (None for failed ones)
+
+    """
+
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+
+    async def send(record):
+        # Wait for the request's (scaled) time.
+        if speed:
+            delay = (record["time"] - records[0]["time"]) / speed
+            await asyncio.sleep(max(start + delay - loop.time(), 0))
+
+        sent = loop.time()
+        try:
+            reader, writer = await asyncio.open_connection(*proxy)
+            writer.write(build_request(record, upstream))
+            await writer.drain()
+
+            # Proxy closes the connection after the response.
+            await reader.read()
+            writer.close()
+        except OSError:
+            return None
+
+        return loop.time() - sent
+
+    return await asyncio.gather(*[send(record) for record in records])
+
+
+def _summary(latencies):
+    "Median and 95th percentile of latencies [ms] as text."
+
+    latencies = sorted(latency for latency in latencies
+                       if latency is not None)
+    if not latencies:
+        return "no successful requests"
+
+    return "median {:.1f} ms, p95 {:.1f} ms".format(
+        statistics.median(latencies) * 1000,
+        latencies[int(0.95 * (len(latencies) - 1))] * 1000)
+
+
+def _address(value):
+    "Parse host:port argument."
+
+    host, port = value.rsplit(":", maxsplit=1)
+    return host, int(port)
+
+
+def _format_latency(latency):
+    return "failed" if latency is None else "{:.1f}".format(latency * 1000)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay traffic captured by the proxy (see "
+                    "PROXY_CAPTURE_FILE) against local upstream stand-in.")
+    parser.add_argument("capture", help="captured traffic JSON lines file")
+    parser.add_argument("--proxy", action="append", type=_address,
+                        required=True,
+                        help="host:port of proxy, given twice compares "
+                             "latencies of two proxy builds")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="timing scale, 2 replays twice as fast, 0 sends "
+                             "all requests at once")
+    parser.add_argument("--upstream-port", type=int, default=0,
+                        help="port of upstream stand-in")
+    args = parser.parse_args()
+
+    with open(args.capture) as capture:
+        records = sorted(
+            (json.loads(line) for line in capture if line.strip()),
+            key=lambda record: record["time"])
+
+    loop = asyncio.get_event_loop()
+    upstream_server = loop.run_until_complete(asyncio.start_server(
+        handle_upstream, "127.0.0.1", args.upstream_port))
+    upstream = upstream_server.sockets[0].getsockname()[:2]
+
+    # Replay against each proxy in turn.
+    results = [loop.run_until_complete(replay(records, proxy, upstream,
+                                              args.speed))
+               for proxy in args.proxy]
+
+    print("#    method  target  latencies [ms]")
+    for i, record in enumerate(records):
+        latencies = [result[i] for result in results]
+        line = "{:<4} {:<7} {}  {}".format(
+            i, record["method"], record["target"],
+            "  ".join(_format_latency(latency) for latency in latencies))
+        if len(latencies) == 2 and None not in latencies:
+            line += "  ({:+.1f})".format(
+                (latencies[1] - latencies[0]) * 1000)
+        print(line)
+
+    for proxy, latencies in zip(args.proxy, results):
+        print("{}:{}: {}".format(proxy[0], proxy[1], _summary(latencies)))
+
+    upstream_server.close()
+    loop.run_until_complete(upstream_server.wait_closed())
+    loop.close()
@@ -11,7 +11,11 @@ setup(name="Async proxy",
       scripts=["proxy.py"],
       install_requires=["werkzeug"],
       extras_require={
+          "h2c": [
+              "h2",
+          ],
           "tests": [
+              "h2",
               "pytest",
               "requests",
           ],
@@ -1,4 +1,8 @@
 import asyncio
+import json
+import socket
+import subprocess
+import zlib
 from unittest import mock
 
 import proxy
@@ -14,6 +18,12 @@ class MockWriter:
     async def drain(self):
         pass
 
+    def close(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
 
 def test_relay_to_client():
     async def test_write(reader):
@@ -60,3 +70,675 @@ def test_relay_to_remote():
         loop = asyncio.get_event_loop()
         loop.run_until_complete(_relay(loop))
         # loop.close()
+
+
+def test_interleave_addresses():
+    addrinfos = [
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("::1", 80, 0, 0)),
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("::2", 80, 0, 0)),
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("::1", 80, 0, 0)),
+        (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.1", 80)),
+    ]
+
+    addresses = proxy._interleave_addresses(addrinfos)
+
+    assert [address[3] for address in addresses] == [
+        ("::1", 80, 0, 0), ("10.0.0.1", 80), ("::2", 80, 0, 0)]
+
+
+def test_address_failure_cache():
+    failures = proxy.AddressFailureCache(ttl=10)
+    failures.add(("10.0.0.1", 80))
+
+    assert ("10.0.0.1", 80) in failures
+    assert ("10.0.0.2", 80) not in failures
+
+    with mock.patch.object(proxy.time, "monotonic",
+                           return_value=proxy.time.monotonic() + 11):
+        assert ("10.0.0.1", 80) not in failures
+
+    # Expired failures of addresses not tried since are forgotten on adding.
+    failures.add(("10.0.0.2", 80))
+    failures.add(("10.0.0.3", 80))
+    failures.add(("10.0.0.2", 80))
+    assert len(failures) == 2
+
+    with mock.patch.object(proxy.time, "monotonic",
+                           return_value=proxy.time.monotonic() + 11):
+        failures.add(("10.0.0.4", 80))
+
+    assert len(failures) == 1
+
+
+def test_race_connections():
+    blackholed = (socket.AF_INET, socket.SOCK_STREAM, 6, ("10.0.0.1", 80))
+    refused = (socket.AF_INET, socket.SOCK_STREAM, 6, ("10.0.0.2", 80))
+    working = (socket.AF_INET, socket.SOCK_STREAM, 6, ("10.0.0.3", 80))
+
+    async def connect_address(address):
+        if address == blackholed:
+            await asyncio.sleep(60)
+        elif address == refused:
+            raise ConnectionRefusedError()
+        return "reader", address
+
+    async def _race(loop):
+        failures = proxy.AddressFailureCache()
+        start = loop.time()
+
+        streams = await proxy._race_connections(
+            [blackholed, refused, working], failures)
+
+        # Blackholed address delayed the others by one attempt delay only.
+        assert streams == ("reader", working)
+        assert loop.time() - start < 1
+        assert ("10.0.0.2", 80) in failures
+        assert ("10.0.0.1", 80) not in failures
+
+    with mock.patch.object(proxy, "_connect_address", new=connect_address), \
+            mock.patch.object(proxy, "CONNECT_ATTEMPT_DELAY", new=0.05):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(_race(loop))
+
+
+def test_race_connections_timeout():
+    blackholed = (socket.AF_INET, socket.SOCK_STREAM, 6, ("10.0.0.1", 80))
+
+    async def connect_address(address):
+        await asyncio.sleep(60)
+
+    async def _race(loop):
+        failures = proxy.AddressFailureCache()
+
+        try:
+            await proxy._race_connections([blackholed], failures, timeout=0.1)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            assert False, "Race didn't time out"
+
+        # Blackholed address is tried last next time.
+        assert ("10.0.0.1", 80) in failures
+
+    with mock.patch.object(proxy, "_connect_address", new=connect_address):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(_race(loop))
+
+
+def test_open_remote_connection_recently_failed():
+    async def _connect(loop):
+        server = await asyncio.start_server(
+            lambda reader, writer: writer.close(), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        failures = proxy.AddressFailureCache()
+        failures.add(("127.0.0.1", port))
+
+        # Only address recently failed - it's still tried.
+        reader, writer = await proxy.open_remote_connection(
+            "127.0.0.1", port, failures)
+        writer.close()
+
+        server.close()
+        await server.wait_closed()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_connect(loop))
+
+
+def test_on_connected_bad_gateway():
+    async def _connect(loop):
+        # Grab a free port and release it, so nothing listens on it.
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(b"GET / HTTP/1.1\r\n")
+        reader.feed_data("Host: 127.0.0.1:{}\r\n\r\n".format(port).encode())
+        reader.feed_eof()
+        writer = MockWriter()
+        failures = proxy.AddressFailureCache()
+
+        await proxy.on_connected(reader, writer, ("0.0.0.0", 8000),
+                                 proxy.Stats(), failures)
+
+        assert writer.data[0].startswith(b"HTTP/1.1 502 Bad Gateway\r\n")
+        assert ("127.0.0.1", port) in failures
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_connect(loop))
+
+
+BODY = bytes(range(100))
+
+
+async def _start_origin(loop, handle_ranges=True, etags=None,
+                        responses=None, requests=None):
+    """Start minimal origin serving ``BODY``, returning (server, port).
+
+    Optional ``etags`` iterator gives ETag of each response, ``responses``
+    limits number of requests responded to - the others are closed right away.
+    Request lines are appended to optional ``requests`` list.
+
+    """
+
+    async def handle(reader, writer):
+        nonlocal responses
+        request_line = await reader.readline()
+        if requests is not None:
+            requests.append(request_line)
+        bytes_ranges = None
+        if_range = None
+        while True:
+            line = await reader.readline()
+            if not line or line == b"\r\n":
+                break
+            key, value = line.decode().split(":", maxsplit=1)
+            if key.lower() == "range":
+                bytes_ranges = proxy.werkzeug.http.parse_range_header(
+                    value.strip())
+            elif key.lower() == "if-range":
+                if_range = value.strip()
+
+        if responses is not None:
+            if not responses:
+                writer.close()
+                return
+            responses -= 1
+
+        etag = next(etags) if etags is not None else None
+        if if_range is not None and if_range != etag:
+            bytes_ranges = None
+
+        if handle_ranges and bytes_ranges \
+                and bytes_ranges.ranges[0][0] >= len(BODY):
+            writer.write(b"HTTP/1.1 416 Range Not Satisfiable\r\n")
+            data = b""
+        elif handle_ranges and bytes_ranges:
+            start, stop = bytes_ranges.ranges[0]
+            if start < 0:
+                start, stop = len(BODY) + start, len(BODY)
+            stop = min(stop or len(BODY), len(BODY))
+            writer.write(b"HTTP/1.1 206 Partial Content\r\n")
+            writer.write("Content-Range: bytes {}-{}/{}\r\n".format(
+                start, stop - 1, len(BODY)).encode())
+            data = BODY[start:stop]
+        else:
+            writer.write(b"HTTP/1.1 200 OK\r\n")
+            data = BODY
+        if etag is not None:
+            writer.write("ETag: {}\r\n".format(etag).encode())
+        writer.write(b"Content-Length: %d\r\n\r\n" % len(data))
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def _relay_segmented(bytes_ranges=None, **origin):
+    async def _relay(loop):
+        server, port = await _start_origin(loop, **origin)
+        client = MockWriter()
+        headers = ("GET / HTTP/1.1\r\n"
+                   "Host: 127.0.0.1:{}\r\n".format(port))
+
+        stats = proxy.Stats()
+        relayed = await proxy.relay_segmented_to_client(
+            client, stats, "127.0.0.1", port, headers,
+            bytes_ranges, proxy.AddressFailureCache())
+        assert stats.sub_request_connections == 0
+
+        server.close()
+        await server.wait_closed()
+        return relayed, client.data
+
+    with mock.patch.object(proxy, "SEGMENT_SIZE", new=16), \
+            mock.patch.object(proxy, "SEGMENT_CONCURRENCY", new=3):
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(_relay(loop))
+
+
+def test_relay_segmented_to_client():
+    relayed, data = _relay_segmented()
+
+    assert relayed
+    assert data[0].startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"Content-Length: 100\r\n" in data[0]
+    assert b"".join(data[1:]) == BODY
+
+
+def test_relay_segmented_to_client_ranges():
+    bytes_ranges = proxy.werkzeug.http.parse_range_header("bytes=10-49,-5")
+    relayed, data = _relay_segmented(bytes_ranges)
+
+    assert relayed
+    assert data[0].startswith(b"HTTP/1.1 206 Partial Content\r\n")
+    assert b"".join(data[1:]) == BODY[10:50] + BODY[-5:]
+
+
+def test_relay_segmented_to_client_fallback():
+    requests = []
+    bytes_ranges = proxy.werkzeug.http.parse_range_header("bytes=10-19")
+    relayed, data = _relay_segmented(bytes_ranges, handle_ranges=False,
+                                     requests=requests)
+
+    # Response to the first sub-request is relayed, with ranges cut by proxy,
+    # rather than requested again.
+    assert relayed
+    assert len(requests) == 1
+    response = b"".join(data)
+    assert response.startswith(b"HTTP/1.1 206 Partial Content\r\n")
+    assert response.endswith(b"\r\n\r\n" + BODY[10:20])
+
+
+def test_relay_segmented_to_client_changed():
+    # Body changes after the first segment.
+    etags = iter(['"v1"'] + ['"v2"'] * 10)
+    relayed, data = _relay_segmented(etags=etags)
+
+    # Relaying is cut after the first segment, rather than mixing versions.
+    assert relayed
+    assert b"".join(data[1:]) == BODY[:16]
+
+
+def test_relay_segmented_to_client_closed():
+    # Remote server closes sub-requests' connections without response.
+    relayed, data = _relay_segmented(responses=1)
+
+    assert relayed
+    assert b"".join(data[1:]) == BODY[:16]
+
+
+def _relay_compressed(content_type, body):
+    async def test_write(reader):
+        reader.feed_data(b"HTTP/1.0 200 OK\r\n")
+        reader.feed_data(b"Content-Type: " + content_type + b"\r\n")
+        reader.feed_data(b"ETag: \"abc\"\r\n")
+        reader.feed_data(b"Connection: keep-alive\r\n")
+        reader.feed_data(b"Keep-Alive: timeout=5\r\n\r\n")
+        reader.feed_data(body)
+        reader.feed_eof()
+
+    async def _relay(loop):
+        remote = asyncio.StreamReader(loop=loop)
+        client = MockWriter()
+        stats = proxy.Stats()
+
+        await asyncio.wait([
+            loop.create_task(proxy.relay_to_client(
+                remote, client, stats, compress=True)),
+            loop.create_task(test_write(remote)),
+        ])
+
+        return b"".join(client.data), stats
+
+    with mock.patch.object(proxy, "COMPRESSION_BATCH_SIZE", new=4096):
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(_relay(loop))
+
+
+def test_relay_to_client_compressed():
+    body = b"<p>Hello</p>" * 1000
+    response, stats = _relay_compressed(b"text/html; charset=utf-8", body)
+
+    head, chunked = response.split(b"\r\n\r\n", maxsplit=1)
+    assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"Content-Encoding: gzip" in head
+    assert b"Transfer-Encoding: chunked" in head
+    assert b"ETag: W/\"abc\"" in head
+    assert b"Connection: close" in head
+    assert b"keep-alive" not in head.lower()
+
+    # Strip chunked framing.
+    compressed = b""
+    while True:
+        size, chunked = chunked.split(b"\r\n", maxsplit=1)
+        if int(size, 16) == 0:
+            break
+        compressed += chunked[:int(size, 16)]
+        chunked = chunked[int(size, 16) + 2:]
+
+    assert zlib.decompress(compressed, 16 + zlib.MAX_WBITS) == body
+    assert stats.compression_bytes_saved == len(body) - len(compressed)
+    assert stats.compression_bytes_saved > 0
+
+
+def test_relay_to_client_compressed_skipped():
+    # Tiny body.
+    response, stats = _relay_compressed(b"text/html", b"<p>Hello</p>")
+
+    assert response == (b"HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n"
+                        b"ETag: \"abc\"\r\nConnection: keep-alive\r\n"
+                        b"Keep-Alive: timeout=5\r\n\r\n<p>Hello</p>")
+    assert stats.compression_bytes_saved == 0
+
+    # Not compressible content type.
+    body = bytes(2048)
+    response, stats = _relay_compressed(b"image/png", body)
+
+    assert response.endswith(b"\r\n\r\n" + body)
+    assert stats.compression_bytes_saved == 0
+
+
+def test_prefetcher_access():
+    prefetcher = proxy.Prefetcher(proxy.Stats(), segments=2)
+    target = ("example.com", 80, "http://example.com/movie")
+
+    assert prefetcher.access("10.0.0.1", target, 0, 10) == []
+    assert prefetcher.access("10.0.0.1", target, 10, 20) == [(20, 30),
+                                                            (30, 40)]
+    # Other client's walk is tracked separately.
+    assert prefetcher.access("10.0.0.2", target, 20, 30) == []
+    # Non-sequential access resets the walk.
+    assert prefetcher.access("10.0.0.1", target, 50, 60) == []
+    assert prefetcher.access("10.0.0.1", target, 60, 70) == [(70, 80),
+                                                            (80, 90)]
+
+
+def test_on_connected_prefetched():
+    async def _connect(loop):
+        server, port = await _start_origin(loop)
+        stats = proxy.Stats()
+        prefetcher = proxy.Prefetcher(stats, segments=2)
+        failures = proxy.AddressFailureCache()
+        headers = ("GET /movie HTTP/1.1\r\n"
+                   "Host: 127.0.0.1:{}\r\n".format(port))
+        target = ("127.0.0.1", port, "/movie")
+
+        # First segment is cut short by the end of the body, second one is
+        # beyond it.
+        prefetcher.access("", target, 50, 70)
+        segments = prefetcher.access("", target, 70, 90)
+        assert segments == [(90, 110), (110, 130)]
+        for start, stop in segments:
+            await prefetcher.fetch("127.0.0.1", port, failures, headers,
+                                   target, start, stop)
+
+        server.close()
+        await server.wait_closed()
+
+        # Request with credentials isn't served segment prefetched for
+        # another one, but relayed to (now closed) remote server.
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(headers.encode())
+        reader.feed_data(b"Cookie: session=secret\r\n")
+        reader.feed_data(b"Range: bytes=90-109\r\n\r\n")
+        reader.feed_eof()
+        writer = MockWriter()
+
+        await proxy.on_connected(reader, writer, ("0.0.0.0", 8000), stats,
+                                 failures, prefetcher)
+
+        assert writer.data[0].startswith(b"HTTP/1.1 502 Bad Gateway\r\n")
+        assert stats.prefetch_hits == 0
+
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(headers.encode())
+        reader.feed_data(b"Range: bytes=90-109\r\n\r\n")
+        reader.feed_eof()
+        writer = MockWriter()
+
+        await proxy.on_connected(reader, writer, ("0.0.0.0", 8000), stats,
+                                 failures, prefetcher)
+
+        assert writer.data[0].startswith(b"HTTP/1.1 206 Partial Content\r\n")
+        assert b"Content-Range: bytes 90-99/100\r\n" in writer.data[0]
+        assert writer.data[1] == BODY[90:]
+        assert stats.prefetch_segments == 1
+        assert stats.prefetch_hits == 1
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_connect(loop))
+
+
+def test_prefetcher_wasted():
+    async def _fetch(loop):
+        server, port = await _start_origin(loop)
+        stats = proxy.Stats()
+        prefetcher = proxy.Prefetcher(stats, segments=2, store_size=25)
+        headers = ("GET / HTTP/1.1\r\n"
+                   "Host: 127.0.0.1:{}\r\n".format(port))
+        target = ("127.0.0.1", port, "/")
+
+        for start in (0, 10, 20):
+            await prefetcher.fetch("127.0.0.1", port,
+                                   proxy.AddressFailureCache(), headers,
+                                   target, start, start + 10)
+
+        server.close()
+        await server.wait_closed()
+
+        # The oldest segment didn't fit in the store.
+        assert stats.prefetch_wasted_bytes == 10
+        assert await prefetcher.get(target, 0, 10) is None
+        assert await prefetcher.get(target, 10, 20) == (mock.ANY, BODY[10:20])
+        assert stats.dictionary["prefetch_hit_rate"] == 1 / 3
+
+        # Expired segments are evicted on any access, as client stopped
+        # walking the object.
+        with mock.patch.object(
+                proxy.time, "monotonic",
+                return_value=proxy.time.monotonic() + proxy.PREFETCH_TTL + 1):
+            assert await prefetcher.get(target, 50, 60) is None
+
+        assert stats.prefetch_wasted_bytes == 20
+        assert await prefetcher.get(target, 20, 30) is None
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_fetch(loop))
+
+
+def test_on_connected_debug_connections():
+    async def _connect(loop):
+        stats = proxy.Stats()
+        stats.sub_request_connections = 2
+        pool = mock.Mock(open_connections=1)
+        connections = proxy.Connections(stats, pool)
+        held = proxy.Connection(MockWriter())
+        held.host, held.port, held.phase = "example.com", 80, "relaying"
+        held.client.write(b"foo")
+        held.remote = proxy.CountingWriter(MockWriter())
+        connections.add(held)
+
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(b"GET /debug/connections HTTP/1.1\r\n\r\n")
+        reader.feed_eof()
+        writer = MockWriter()
+
+        await proxy.on_connected(reader, writer, ("0.0.0.0", 8000),
+                                 stats, connections=connections)
+
+        assert writer.data[0] == b"HTTP/1.1 200 OK\r\n"
+        data = json.loads(writer.data[3].decode())
+        # The endpoint's own connection is listed, too.
+        assert data["totals"]["connections"] == 2
+        # Connections to remote servers of all modes are counted.
+        assert data["totals"]["remote_connections"] == 4
+        assert data["totals"]["remote_connections_by_mode"] == {
+            "relaying": 1, "sub_requests": 2, "h2c": 1}
+        assert data["totals"]["tasks"] >= 1
+        assert data["connections"][0]["host"] == "example.com:80"
+        assert data["connections"][0]["phase"] == "relaying"
+        assert data["connections"][0]["bytes_to_client"] == 3
+
+        # Closed connections are forgotten.
+        assert connections.dictionary["totals"]["connections"] == 1
+        held.client.close()
+        assert connections.dictionary["totals"]["connections"] == 0
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_connect(loop))
+
+
+def test_on_connected_malformed_request():
+    async def _connect(loop):
+        connections = proxy.Connections()
+
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(b"GET / HTTP/1.1\r\n")
+        reader.feed_data(b"no colon\r\n\r\n")
+        reader.feed_eof()
+        writer = MockWriter()
+
+        try:
+            await proxy.on_connected(reader, writer, ("0.0.0.0", 8000),
+                                     proxy.Stats(), connections=connections)
+        except ValueError:
+            pass
+
+        # Failed connection is not accounted forever.
+        assert len(connections) == 0
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_connect(loop))
+
+
+def test_capture(tmpdir):
+    path = str(tmpdir.join("capture.jsonl"))
+    capture = proxy.Capture(path)
+    connection = proxy.Connection(MockWriter())
+    connection.host, connection.port = "example.com", 80
+    headers = ("POST http://example.com/form?a=1 HTTP/1.1\r\n"
+               "Host: example.com\r\n"
+               "Cookie: secret\r\n"
+               "Content-Length: 4\r\n"
+               "Range: bytes=0-9\r\n")
+
+    capture.record(connection, headers,
+                   proxy.werkzeug.http.parse_range_header("bytes=0-9"))
+    head = (b"HTTP/1.1 206 Partial Content\r\n"
+            b"Content-Range: bytes 0-5/1000\r\n\r\n")
+    connection.client.write(head[:20])
+    connection.client.write(head[20:] + b"foo")
+    connection.client.write(b"bar")
+    connection.client.close()
+    capture.close()
+
+    with open(path) as captured:
+        record = json.loads(captured.readline())
+
+    assert record["method"] == "POST"
+    assert (record["host"], record["port"]) == ("example.com", 80)
+    assert record["target"] == "http://example.com/form?a=1"
+    assert ["Cookie", "<redacted>"] in record["headers"]
+    assert record["ranges"] == "bytes=0-9"
+    assert record["body_size"] == 4
+    assert record["response_bytes"] == len(head) + 6
+    assert record["response_body_bytes"] == 6
+    assert record["object_size"] == 1000
+    assert record["duration"] >= 0
+
+
+def test_drain():
+    async def _drain(loop):
+        server = mock.Mock()
+        connections = proxy.Connections()
+        stats = proxy.Stats()
+        held = proxy.Connection(MockWriter())
+        held.phase = "relaying"
+        connections.add(held)
+        loop.call_later(0.1, held.client.close)
+        # Connection still reading its request isn't waited for.
+        connections.add(proxy.Connection(MockWriter()))
+
+        cut = await proxy.drain(server, connections, stats)
+
+        assert cut == 0
+        assert server.close.called
+        assert stats.dictionary["draining"]["connections"] == 0
+
+        # Connections still active at the deadline are cut.
+        held = proxy.Connection(MockWriter())
+        held.phase = "relaying"
+        connections.add(held)
+        with mock.patch.object(proxy, "DRAIN_TIMEOUT", new=0.1):
+            cut = await proxy.drain(server, connections, stats,
+                                    close_server=False)
+
+        assert cut == 1
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_drain(loop))
+
+
+def _spawn_successor(argv):
+    """Spawn successor running argv, return (successor, response to GET
+    /stats through the handed over socket)."""
+
+    async def _spawn(loop):
+        server = await asyncio.start_server(
+            lambda reader, writer: writer.close(), "127.0.0.1", 0)
+        address = server.sockets[0].getsockname()[:2]
+
+        with mock.patch.object(proxy.sys, "argv", new=argv):
+            successor = await proxy.spawn_successor(server)
+
+        server.close()
+        await server.wait_closed()
+        if successor is None:
+            return None, None
+
+        # Handed over socket is served by the new process.
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(b"GET /stats HTTP/1.1\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+
+        successor.kill()
+        successor.wait()
+        return successor, response
+
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(_spawn(loop))
+
+
+def test_spawn_successor():
+    successor, response = _spawn_successor([proxy.__file__])
+
+    assert successor is not None
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+
+
+def test_spawn_successor_failed():
+    # New process exits right away.
+    successor, _ = _spawn_successor(["-c", "import sys; sys.exit(1)"])
+
+    assert successor is None
+
+    # New process doesn't report it serves the socket in time - it's killed.
+    processes = []
+    original_popen = subprocess.Popen
+
+    def popen(*args, **kwargs):
+        processes.append(original_popen(*args, **kwargs))
+        return processes[-1]
+
+    with mock.patch.object(proxy.subprocess, "Popen", new=popen), \
+            mock.patch.object(proxy, "SUCCESSOR_TIMEOUT", new=0.5):
+        successor, _ = _spawn_successor(["-c", "import time; time.sleep(60)"])
+
+    assert successor is None
+    assert processes[0].returncode is not None
+
+
+def test_on_connected_draining():
+    async def _connect(loop):
+        stats = proxy.Stats()
+        stats.drain_deadline = proxy.time.time() + 10
+
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(b"GET http://example.com/ HTTP/1.1\r\n")
+        reader.feed_data(b"Host: example.com\r\n\r\n")
+        reader.feed_eof()
+        writer = MockWriter()
+
+        await proxy.on_connected(reader, writer, ("0.0.0.0", 8000), stats)
+
+        assert writer.data[0].startswith(
+            b"HTTP/1.1 503 Service Unavailable\r\n")
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_connect(loop))
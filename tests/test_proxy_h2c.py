@@ -0,0 +1,368 @@
+import asyncio
+import socket
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("h2")
+
+import h2.config  # noqa: E402
+import h2.connection  # noqa: E402
+import h2.events  # noqa: E402
+import h2.exceptions  # noqa: E402
+import h2.settings  # noqa: E402
+import hyperframe.frame  # noqa: E402
+
+import proxy  # noqa: E402
+
+
+class MockWriter:
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data += [data]
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+H2C_BODY = bytes(range(256)) * 1200  # More than a stream's window.
+
+
+async def _start_h2c_origin(loop, max_streams=None, goaway=False):
+    """Start minimal h2c origin serving ``H2C_BODY`` (echoing request bodies),
+    returning (server, port, list of its h2 connections).
+
+    With ``goaway``, it sends graceful GOAWAY right after response headers.
+
+    """
+
+    connections = []
+
+    async def handle(reader, writer):
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(
+            client_side=False, header_encoding="utf-8"))
+        if max_streams is not None:
+            conn.local_settings = h2.settings.Settings(
+                client=False, initial_values={
+                    h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS:
+                        max_streams})
+        conn.initiate_connection()
+        writer.write(conn.data_to_send())
+        connections.append(conn)
+        requests = {}  # Stream ID -> (headers, body).
+        window_updated = [asyncio.Event()]
+
+        async def respond(stream_id):
+            headers, body = requests.pop(stream_id)
+            if headers[":method"] == "POST":
+                status, data = 200, bytes(body)
+            elif "range" in headers:
+                ranges = proxy.werkzeug.http.parse_range_header(
+                    headers["range"])
+                start, stop = ranges.range_for_length(len(H2C_BODY))
+                status, data = 206, H2C_BODY[start:stop]
+            else:
+                status, data = 200, H2C_BODY
+
+            response_headers = [(":status", str(status)),
+                                ("content-length", str(len(data)))]
+            if status == 206:
+                response_headers.append(("content-range",
+                                         "bytes {}-{}/{}".format(
+                                             start, stop - 1, len(H2C_BODY))))
+            conn.send_headers(stream_id, response_headers)
+            if goaway:
+                writer.write(conn.data_to_send())
+                writer.write(hyperframe.frame.GoAwayFrame(
+                    last_stream_id=stream_id).serialize())
+            try:
+                while data:
+                    size = min(len(data), conn.max_outbound_frame_size,
+                               conn.local_flow_control_window(stream_id))
+                    if size <= 0:
+                        await window_updated[0].wait()
+                        continue
+                    conn.send_data(stream_id, data[:size])
+                    data = data[size:]
+                    writer.write(conn.data_to_send())
+                    await writer.drain()
+                conn.end_stream(stream_id)
+            except h2.exceptions.StreamClosedError:
+                pass  # Reset by the proxy.
+            writer.write(conn.data_to_send())
+
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    requests[event.stream_id] = (dict(event.headers),
+                                                 bytearray())
+                elif isinstance(event, h2.events.DataReceived):
+                    requests[event.stream_id][1].extend(event.data)
+                    conn.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    asyncio.ensure_future(respond(event.stream_id))
+                elif isinstance(event, (h2.events.WindowUpdated,
+                                        h2.events.StreamReset)):
+                    window_updated[0].set()
+                    window_updated[0] = asyncio.Event()
+            writer.write(conn.data_to_send())
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1], connections
+
+
+def test_h2c_request_headers():
+    headers = ("GET http://example.com:8080/a?b=c HTTP/1.1\r\n"
+               "Host: example.com:8080\r\n"
+               "Connection: keep-alive\r\n"
+               "Range: bytes=0-9\r\n")
+
+    assert proxy._h2c_request_headers(headers) == [
+        (":method", "GET"),
+        (":scheme", "http"),
+        (":authority", "example.com:8080"),
+        (":path", "/a?b=c"),
+        ("range", "bytes=0-9"),
+    ]
+
+
+def _on_connected_h2c(requests, **kwargs):
+    """Send requests concurrently through proxy to h2c origin (started with
+    ``kwargs``), returning responses and number of connections to the
+    origin."""
+
+    async def _connect(loop):
+        server, port, connections = await _start_h2c_origin(loop, **kwargs)
+        pool = proxy.H2cPool([("127.0.0.1", port)], max_connections=1)
+
+        async def request(data):
+            reader = asyncio.StreamReader(loop=loop)
+            reader.feed_data(data.format(port=port).encode())
+            writer = MockWriter()
+            await proxy.on_connected(reader, writer, ("0.0.0.0", 8000),
+                                     proxy.Stats(), h2c_pool=pool)
+            return b"".join(writer.data)
+
+        responses = await asyncio.gather(*[request(data)
+                                           for data in requests])
+        assert pool.open_connections == 1
+
+        await pool.close()
+        server.close()
+        await server.wait_closed()
+        return responses, len(connections)
+
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(_connect(loop))
+
+
+def test_on_connected_h2c():
+    get = ("GET http://127.0.0.1:{port}/ HTTP/1.1\r\n"
+           "Host: 127.0.0.1:{port}\r\n\r\n")
+    ranged = ("GET http://127.0.0.1:{port}/ HTTP/1.1\r\n"
+              "Host: 127.0.0.1:{port}\r\n"
+              "Range: bytes=10-19\r\n\r\n")
+    post = ("POST http://127.0.0.1:{port}/ HTTP/1.1\r\n"
+            "Host: 127.0.0.1:{port}\r\n"
+            "Content-Length: 6\r\n\r\n"
+            "foobar")
+
+    responses, connections = _on_connected_h2c([get] * 3 + [ranged, post])
+
+    # All requests multiplexed over single connection.
+    assert connections == 1
+    for response in responses[:3]:
+        head, body = response.split(b"\r\n\r\n", maxsplit=1)
+        assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert b"Content-Length: %d\r\n" % len(H2C_BODY) in head
+        assert body == H2C_BODY
+
+    head, body = responses[3].split(b"\r\n\r\n", maxsplit=1)
+    assert head.startswith(b"HTTP/1.1 206 Partial Content\r\n")
+    assert b"Content-Range: bytes 10-19/" in head
+    assert body == H2C_BODY[10:20]
+
+    assert responses[4].endswith(b"\r\n\r\nfoobar")
+
+
+def test_on_connected_h2c_stream_limit():
+    # Requests over origin's limit of concurrent streams wait for a free one.
+    get = ("GET http://127.0.0.1:{port}/ HTTP/1.1\r\n"
+           "Host: 127.0.0.1:{port}\r\n\r\n")
+
+    responses, connections = _on_connected_h2c([get] * 4, max_streams=1)
+
+    assert connections == 1
+    for response in responses:
+        head, body = response.split(b"\r\n\r\n", maxsplit=1)
+        assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert body == H2C_BODY
+
+
+def test_h2c_goaway():
+    async def _request(loop):
+        server, port, connections = await _start_h2c_origin(loop,
+                                                            goaway=True)
+        pool = proxy.H2cPool([("127.0.0.1", port)], max_connections=1)
+
+        async def request():
+            reader = asyncio.StreamReader(loop=loop)
+            reader.feed_data("GET http://127.0.0.1:{port}/ HTTP/1.1\r\n"
+                             "Host: 127.0.0.1:{port}\r\n\r\n"
+                             .format(port=port).encode())
+            writer = MockWriter()
+            await proxy.on_connected(reader, writer, ("0.0.0.0", 8000),
+                                     proxy.Stats(), h2c_pool=pool)
+            return b"".join(writer.data)
+
+        responses = [await request(), await request()]
+
+        await pool.close()
+        server.close()
+        await server.wait_closed()
+        return responses, len(connections)
+
+    loop = asyncio.get_event_loop()
+    responses, connections = loop.run_until_complete(_request(loop))
+
+    # Streams finish after GOAWAY, but new ones use a new connection.
+    for response in responses:
+        assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert response.endswith(b"\r\n\r\n" + H2C_BODY)
+    assert connections == 2
+
+
+def test_on_connected_h2c_client_ranges():
+    # Ranges specified in query only are handled by origin, too.
+    ranged = ("GET http://127.0.0.1:{port}/?range=bytes%3D-5 HTTP/1.1\r\n"
+              "Host: 127.0.0.1:{port}\r\n\r\n")
+
+    (response,), _ = _on_connected_h2c([ranged])
+
+    assert response.startswith(b"HTTP/1.1 206 Partial Content\r\n")
+    assert response.endswith(b"\r\n\r\n" + H2C_BODY[-5:])
+
+
+def test_h2c_pool_refused():
+    async def _request(loop):
+        # Grab a free port and release it, so nothing listens on it.
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        pool = proxy.H2cPool([("127.0.0.1", port)], max_connections=1)
+        failures = proxy.AddressFailureCache()
+        start = loop.time()
+
+        # Both requests fail fast - not only the one opening the connection.
+        results = await asyncio.gather(
+            *[pool.request("127.0.0.1", port, failures, [], True)
+              for _ in range(2)],
+            return_exceptions=True)
+
+        assert all(isinstance(result, ConnectionRefusedError)
+                   for result in results)
+        assert loop.time() - start < 1
+
+        await pool.close()
+
+    with mock.patch.object(proxy, "CONNECT_TIMEOUT", new=5):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(_request(loop))
+
+
+def test_on_connected_h2c_bad_content_length():
+    async def _request(loop):
+        # Nothing listens on the port - the request never gets that far.
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        pool = proxy.H2cPool([("127.0.0.1", port)], max_connections=1)
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data("POST http://127.0.0.1:{port}/ HTTP/1.1\r\n"
+                         "Host: 127.0.0.1:{port}\r\n"
+                         "Content-Length: six\r\n\r\n"
+                         "foobar".format(port=port).encode())
+        writer = MockWriter()
+        await proxy.on_connected(reader, writer, ("0.0.0.0", 8000),
+                                 proxy.Stats(), h2c_pool=pool)
+        return b"".join(writer.data)
+
+    loop = asyncio.get_event_loop()
+    response = loop.run_until_complete(_request(loop))
+
+    assert response.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+
+
+def test_on_connected_h2c_client_gone():
+    class GoneWriter(MockWriter):
+        async def drain(self):
+            raise ConnectionResetError()
+
+    async def _request(loop):
+        server, port, _ = await _start_h2c_origin(loop)
+        pool = proxy.H2cPool([("127.0.0.1", port)], max_connections=1)
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data("GET http://127.0.0.1:{port}/ HTTP/1.1\r\n"
+                         "Host: 127.0.0.1:{port}\r\n\r\n"
+                         .format(port=port).encode())
+
+        # Client going away isn't an error of the proxy.
+        await proxy.on_connected(reader, GoneWriter(), ("0.0.0.0", 8000),
+                                 proxy.Stats(), h2c_pool=pool)
+
+        await pool.close()
+        server.close()
+        await server.wait_closed()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_request(loop))
+
+
+def test_h2c_stream_closed_acknowledged():
+    async def _request(loop):
+        server, port, _ = await _start_h2c_origin(loop)
+        pool = proxy.H2cPool([("127.0.0.1", port)])
+        failures = proxy.AddressFailureCache()
+        headers = proxy._h2c_request_headers(
+            "GET http://127.0.0.1:{}/ HTTP/1.1\r\n".format(port))
+
+        for _ in range(3):
+            stream = await pool.request("127.0.0.1", port, failures, headers,
+                                        True)
+            # Client went away after reading the head, with the stream's
+            # window of body received meanwhile.
+            await stream.readline()
+            await asyncio.sleep(0.1)
+            stream.close()
+
+        # Body not consumed isn't lost from connection's window - remote
+        # server is given its window back (once half of it is consumed).
+        connection = stream.connection
+        await asyncio.sleep(0.1)
+        assert connection._h2.inbound_flow_control_window \
+            >= proxy.H2C_CONNECTION_WINDOW // 2
+
+        await pool.close()
+        server.close()
+        await server.wait_closed()
+
+    with mock.patch.object(proxy, "H2C_CONNECTION_WINDOW", new=1024 * 1024):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(_request(loop))
@@ -0,0 +1,94 @@
+import asyncio
+
+import replay
+
+
+RECORD = {
+    "time": 1000.0,
+    "method": "POST",
+    "host": "example.com",
+    "port": 80,
+    "target": "http://example.com/form?a=1",
+    "headers": [["Host", "example.com"], ["Range", "bytes=0-9"],
+                ["Content-Length", "4"]],
+    "ranges": "bytes=0-9",
+    "body_size": 4,
+    "duration": 0.1,
+    "response_bytes": 80,
+    "response_body_bytes": 10,
+    "object_size": 1000,
+}
+
+
+def test_build_request():
+    request = replay.build_request(RECORD, ("127.0.0.1", 8002))
+
+    assert request == (b"POST http://127.0.0.1:8002/form?a=1 HTTP/1.1\r\n"
+                       b"Host: 127.0.0.1:8002\r\n"
+                       b"Range: bytes=0-9\r\n"
+                       b"Content-Length: 4\r\n"
+                       b"X-Replay-Response-Size: 10\r\n"
+                       b"X-Replay-Object-Size: 1000\r\n"
+                       b"Connection: close\r\n\r\n"
+                       b"\x00\x00\x00\x00")
+
+
+def test_replay():
+    async def _replay(loop):
+        # Stand-in accepts proxy-style requests, so it can stand in for the
+        # proxy, too.
+        server = await asyncio.start_server(replay.handle_upstream,
+                                            "127.0.0.1", 0)
+        address = server.sockets[0].getsockname()[:2]
+        records = [RECORD, dict(RECORD, time=1000.2)]
+        start = loop.time()
+
+        latencies = await replay.replay(records, address, address, speed=2)
+
+        # Second request was sent 0.1 s after the first one.
+        assert loop.time() - start >= 0.1
+        assert len(latencies) == 2
+        assert None not in latencies
+
+        server.close()
+        await server.wait_closed()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_replay(loop))
+
+
+def _request_upstream(request):
+    async def _request(loop):
+        server = await asyncio.start_server(replay.handle_upstream,
+                                            "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection(
+            *server.sockets[0].getsockname()[:2])
+        writer.write(request)
+        response = await reader.read()
+        writer.close()
+
+        server.close()
+        await server.wait_closed()
+        return response
+
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(_request(loop))
+
+
+def test_handle_upstream_range():
+    response = _request_upstream(replay.build_request(
+        dict(RECORD, headers=[["Range", "bytes=990-1999"]]),
+        ("127.0.0.1", 8002)))
+
+    head, body = response.split(b"\r\n\r\n", maxsplit=1)
+    assert head.startswith(b"HTTP/1.1 206 Partial Content\r\n")
+    assert b"Content-Range: bytes 990-999/1000\r\n" in head
+    assert len(body) == 10
+
+    # Object of unknown size.
+    response = _request_upstream(replay.build_request(
+        dict(RECORD, object_size=None), ("127.0.0.1", 8002)))
+
+    head, body = response.split(b"\r\n\r\n", maxsplit=1)
+    assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert len(body) == 10